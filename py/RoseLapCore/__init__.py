@@ -4,27 +4,32 @@ sys.path.append(os.path.dirname(__file__))
 __all__ = ['packer', 'input_processing', 'batcher']
 
 import input_processing
+import input_processing.track_segmentation as track_segmentation
 import batcher
 import packer
+import run_cache
 import argparse
 
-def run(filename):
+def run(filename, workers=None, cache=True, resume=False):
+	# with resume, a result file this study left unfinished is completed rather than started over
+	if cache:
+		track_segmentation.set_segment_cache_dir(run_cache.SEGMENT_DIR)
 	tests, vehicle, tracks, model, out = input_processing.process_input(filename)
-	results = batcher.batch(tests, vehicle, tracks, model, out[1] != 0)
-	directory = packer.pack(results, out[0])
+	study = batcher.study_key(tests, vehicle, tracks, model, out[1])
+	writer = packer.study_writer(out[0], study, resume)
+	results = batcher.batch(tests, vehicle, tracks, model, out[1], workers,
+		cache=run_cache.RunCache() if cache else None, writer=writer)
 
-	return directory
+	return writer.filename
 
 if __name__ == "__main__":
-	# parser = argparse.ArgumentParser()
-	# parser.add_argument("file", help="name of batch config file")
-	# args = parser.parse_args()
+	parser = argparse.ArgumentParser()
+	parser.add_argument("file", nargs='?', default="test_batch.yaml", help="name of batch config file")
+	parser.add_argument("--workers", type=int, help="number of worker processes (default: picked from the number of permutations, see batcher.partitions)")
+	parser.add_argument("--no-cache", dest='cache', action='store_false', help="run every permutation rather than reusing cached runs")
+	parser.add_argument("--resume", action='store_true', help="finish an interrupted run of this study instead of starting over")
+	args = parser.parse_args()
 
-	# print('configuring...')
-	# tests, vehicle, tracks, model, out = input_processing.process_input(args.file)
-	tests, vehicle, tracks, model, out = input_processing.process_input("test_batch.yaml")
 	print('batching...')
-	results = batcher.batch(tests, vehicle, tracks, model, out[1] != 0)
-	print('packing...')
-	packer.pack(results, out[0])
-	print('done!')
\ No newline at end of file
+	directory = run(args.file, args.workers, cache=args.cache, resume=args.resume)
+	print('done! results in %s' % directory)
\ No newline at end of file
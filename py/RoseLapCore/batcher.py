@@ -3,29 +3,73 @@ import itertools
 import multiprocessing
 from multiprocessing import Pool as ThreadPool
 import time
+import hashlib
 import copy as shallow
 import input_processing.track_segmentation as track_segmentation
+import segment_store
+import run_cache
 # import gc
-from sims import constants
+from sims import constants, steady_corners, lanes
 import logging
 import psutil
 import os
 
-def batch(tests, vehicle, tracks, model, include_output):
+def batch(tests, vehicle, tracks, model, include_output, workers=None, chunksize=None, cache=None, writer=None):
+    """
+    Runs every permutation of the study on every track.
+    workers is the number of processes to run permutations in; None picks one with partitions(),
+    and anything below 2 runs serially in this process. chunksize is how many permutations are
+    handed to a worker at a time (None lets pool_chunksize() decide).
+    cache is an optional run_cache.RunCache consulted before running each permutation.
+    include_output is the study's data_percentage: 0 keeps no channel data, 100 keeps every row and
+    anything between keeps about that share of each run's rows (see decimate). True counts as 100.
+    writer is an optional packer.ResultWriter that gets each result as soon as it comes in; outputs
+    then come back as handles onto its file (packer.OutputHandle) rather than arrays, and the writer
+    is closed once the batch is done. Permutations a resumed writer already holds aren't run again.
+    """
+    if include_output is True:
+        include_output = 100
+
     batch = {}
-    batch["vehicle"] = vehicle.__dict__
+    batch["vehicle"] = vehicle.parameters()
     batch["model"] = model.name
 
     permutations, targets, flatTargets, test_vals = listify(tests, vehicle)
 
     batch["axes"] = len(test_vals)
     batch["test_vals"] = buildContents(targets, test_vals)
-    batch["track_data"] = batch_run(flatTargets, permutations, batch["test_vals"], vehicle, tracks, model, include_output)
+    if writer is not None:
+        writer.begin(batch)
+    batch["track_data"] = batch_run(flatTargets, permutations, batch["test_vals"], vehicle, tracks, model, include_output, workers, chunksize, cache, writer)
 
     batch["axiscontents"] = appendLabels(batch["test_vals"], tests)
+    if cache is not None:
+        cache.log_stats()
+    if writer is not None:
+        writer.close(batch)
 
     return batch
 
+def study_key(tests, vehicle, tracks, model, include_output):
+    """
+    MD5 of everything that decides a study's results: the tests, the base vehicle, each track's
+    settings and file contents, the model, the source of the code a solve runs (as the run cache
+    digests it) and include_output. A partial result file is only resumed by a study with the same
+    key (see packer.study_writer), so results from an older solver are never carried on with.
+    """
+    if include_output is True:
+        include_output = 100
+
+    h = hashlib.md5()
+    run_cache.feed(h, tests)
+    run_cache.feed(h, vehicle.parameters())
+    for track in tracks:
+        run_cache.feed(h, tuple(track) + (track_segmentation.file_hash(track[0]),))
+    run_cache.feed(h, model.name)
+    run_cache.feed(h, run_cache.digest_files(run_cache.code_sources(model, vehicle)))
+    run_cache.feed(h, include_output)
+    return h.hexdigest()
+
 def buildContents(targets, test_vals):
     contents = []
 
@@ -95,24 +139,80 @@ def permutation_extend(base, extensions):
     return permutation_extend(res, extensions[1 :])
 
 def run_permutation(thread_data):
-    index, prepped_vehicle, solver, steady_state, include_output, segments, dl, perm = thread_data
+    index, prepped_vehicle, solver, steady_state, include_output, segments, dl, perm, cache_entry = thread_data
+    segments = segment_store.resolve(segments)
     print('\tRunning Permutation: %s' % (repr(perm)))
     logging.info("Running Permutation: %s" % repr(perm))
     logging.debug(repr(psutil.Process(os.getpid()).memory_info().rss))
 
     # gc.collect()
+    hits, misses = steady_corners.stats()
     data = solver.steady_solve(prepped_vehicle, segments, dl=dl) if steady_state else solver.solve(prepped_vehicle, segments, dl=dl)
+    corner_stats = (steady_corners.hits - hits, steady_corners.misses - misses)
+
+    if cache_entry is not None:
+        run_cache.store(cache_entry, data)
+
+    # the corner cache lives in whichever process ran this, so its counts travel back with the result
+    return (permutation_result(index, data, include_output), corner_stats)
+
+def run_lanes(group):
+    """
+    run_permutation for a list of thread_data on the same segments and dl, solved in lockstep.
+    Returns run_permutation's result for each; the group's corner cache counts travel with the first.
+    """
+    if len(group) < lanes.MIN_LANES:
+        return [run_permutation(d) for d in group]
+
+    index, prepped_vehicle, solver, steady_state, include_output, segments, dl, perm, cache_entry = group[0]
+    segments = segment_store.resolve(segments)
+    for d in group:
+        print('\tRunning Permutation: %s' % (repr(d[7])))
+        logging.info("Running Permutation: %s" % repr(d[7]))
+    logging.debug(repr(psutil.Process(os.getpid()).memory_info().rss))
+
+    vehicles = [d[1] for d in group]
+    hits, misses = steady_corners.stats()
+    outputs = solver.steady_solve_lanes(vehicles, segments, dl=dl) if steady_state else solver.solve_lanes(vehicles, segments, dl=dl)
+    corner_stats = (steady_corners.hits - hits, steady_corners.misses - misses)
 
+    results = []
+    for d, data in zip(group, outputs):
+        if d[8] is not None:
+            run_cache.store(d[8], data)
+        results.append((permutation_result(d[0], data, include_output), (0, 0)))
+    results[0] = (results[0][0], corner_stats)
+    return results
+
+def permutation_result(index, data, include_output):
     time = index + (float(data[-1, constants.O_TIME]),)
     co2 = float(data[-1, constants.O_CO2])
     #times.append((*index, float(data[-1, 0])))
     #times.append(args)
     
     if include_output:
-        return (time, co2, (index + (data.tolist(),)))
+        # the channel matrix stays an array; the charts take columns of it as lists when they draw
+        return (time, co2, (index + (decimate(data, include_output),)))
     else:
         return (time, co2)
 
+def decimate(data, percentage):
+    """
+    The rows of a channel matrix kept when a study stores percentage of its data: every k-th row,
+    the last row, and each row where the status or sector differs from the row before, so the
+    charts still show every transition where it happens.
+    """
+    if percentage >= 100 or len(data) < 3:
+        return data
+    k = max(int(round(100.0 / percentage)), 1)
+
+    keep = np.zeros(len(data), dtype=bool)
+    keep[::k] = True
+    keep[-1] = True
+    for channel in [constants.O_STATUS, constants.O_SECTORS]:
+        keep[1:] |= data[1:, channel] != data[:-1, channel]
+    return data[keep]
+
 
 def generate_co2s(outputs):
     # logging.debug('generating co2s for %s' % outputs)
@@ -123,10 +223,9 @@ def generate_co2s(outputs):
 
     return co2s
 
-def batch_run(targets, permutations, contents, vehicle, tracks, model, include_output):
+def batch_run(targets, permutations, contents, vehicle, tracks, model, include_output, workers=None, chunksize=None, cache=None, writer=None):
 
-    test_data = []
-    n_threads = partitions(len(permutations))
+    n_threads = partitions(len(permutations)) if workers is None else max(int(workers), 1)
 
     # logging.debug('permutations = %s' % repr(permutations))
     
@@ -136,12 +235,28 @@ def batch_run(targets, permutations, contents, vehicle, tracks, model, include_o
     print("threading...", n_threads)
     logging.info("Threading %d threads..." % n_threads)
 
-    # pool = ThreadPool(n_threads)
-    # pool.map(stretch, [i for i in range(n_threads)])
+    pool = None
+    store = None
+    if n_threads > 1:
+        pool = ThreadPool(n_threads)
+        store = segment_store.SegmentStore()
 
     print("running...")
 
-    for track in tracks:
+    try:
+        test_data = run_tracks(pool, store, cache, writer, n_threads, chunksize, targets, permutations, contents, vehicle, tracks, model, include_output)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            store.close()
+
+    return test_data
+
+def run_tracks(pool, store, cache, writer, n_threads, chunksize, targets, permutations, contents, vehicle, tracks, model, include_output):
+    test_data = []
+
+    for track_no, track in enumerate(tracks):
         fn, dl_default, steady_state, name, point_formula, mins = track
         # print('making segments for %s at %f' % (fn, dl_default))
         # logging.debug('hi there')
@@ -151,27 +266,51 @@ def batch_run(targets, permutations, contents, vehicle, tracks, model, include_o
 
         t0 = time.time()
 
-        unique_segments = False
-        segments = None
-        for target in targets:
-            if target[:6] == 'track.':
-                unique_segments = True
-                break
-        else:
-            segments = track_segmentation.file_to_segments(fn, dl_default, sectors_only=ss_model)
+        track_hash = track_segmentation.file_hash(fn) if cache is not None else None
+
+        # segmentations of this track, keyed on (dl, opts); swept track.* targets can make several
+        track_segments = {}
+        def segments_for(dl, opts):
+            seg_key = (dl, tuple(sorted(opts.items())))
+            if seg_key not in track_segments:
+                segments = track_segmentation.file_to_segments(fn, dl, opts=opts, sectors_only=ss_model)
+                if store is not None:
+                    # workers attach to the stored copy instead of unpickling it with every permutation
+                    segments = store.put("track%d-%d" % (track_no, len(track_segments)), segments)
+                else:
+                    # one set of views for every permutation on this segmentation
+                    segments = segments.views()
+                track_segments[seg_key] = segments
+            return track_segments[seg_key]
 
 
         track_data = {}
         track_data["name"] = name
         track_data["ss"] = steady_state
+        track_data["min_time"] = mins[0]
+        track_data["min_co2"] = mins[1]
+        track_data["scoring"] = point_formula
 
         indicies = generateIndicies(contents)
         # thread_data = [(indicies[i], set_values(vehicle, targets, permutations[i]), model.copy(),
         # steady_state, include_output, segments[i]) for i in range(len(indicies))]
         # [(index, vehicle, model, steady_state, inclue_output, segments), ...]
 
+        thread_results = [None for i in indicies]
+        if writer is not None:
+            writer.begin_track(track_data, len(indicies))
+        def keep(i, result):
+            # a writer takes the result as it comes in, and hands back a handle for its output
+            thread_results[i] = result if writer is None else writer.add(track_no, i, result)
+
         thread_data = []
         for i in range(len(indicies)):
+            if writer is not None:
+                done = writer.result(track_no, i)
+                if done is not None:
+                    thread_results[i] = done
+                    continue
+
             v = shallow.copy(vehicle)
             dl = dl_default
             opts = {}
@@ -188,23 +327,46 @@ def batch_run(targets, permutations, contents, vehicle, tracks, model, include_o
                         opts[target[6:]] = permutations[i][j]
                 else:
                     setattr(v, target, permutations[i][j])
-            if unique_segments:
-                segments = track_segmentation.file_to_segments(fn, dl, opts=opts, sectors_only=ss_model)
             v.prep()
+
+            cache_entry = None
+            if cache is not None:
+                key = cache.key(v, track_hash, dl, opts, model, steady_state)
+                cached = cache.get(key)
+                if cached is not None:
+                    keep(i, permutation_result(indicies[i], cached, include_output))
+                    continue
+                # a study that keeps no output only reads the last row, so it leaves its channel matrices out of the cache
+                if include_output:
+                    cache_entry = cache.path(key)
+
             td = (indicies[i],
                 v,
                 model.copy(),
                 steady_state,
                 include_output,
-                segments,
+                segments_for(dl, opts),
                 dl,
-                repres)
+                repres,
+                cache_entry)
             # print(fn, dl, opts)
             thread_data.append(td)
                 
 
-        # thread_results = pool.map(run_permutation, thread_data)
-        thread_results = [run_permutation(d) for d in thread_data]
+        missing = [i for i, r in enumerate(thread_results) if r is None]
+        fresh_results = map_permutations(pool, n_threads, chunksize, thread_data)
+        corner_hits, corner_misses = 0, 0
+        for i, (result, corner_stats) in zip(missing, fresh_results):
+            keep(i, result)
+            corner_hits += corner_stats[0]
+            corner_misses += corner_stats[1]
+
+        if corner_hits + corner_misses > 0:
+            logging.info("Steady corner cache: %d hits, %d misses (%.1f%% hit rate)" %
+                (corner_hits, corner_misses, 100.0 * corner_hits / (corner_hits + corner_misses)))
+
+        if cache is not None:
+            cache.log_track(name)
 
         print("\ttrack completed in:", time.time() - t0, "seconds")
 
@@ -225,15 +387,69 @@ def batch_run(targets, permutations, contents, vehicle, tracks, model, include_o
 
         track_data["times"] = times
         track_data["outputs"] = outputs
-        track_data["min_time"] = mins[0]
-        track_data["min_co2"] = mins[1]
-        track_data["scoring"] = point_formula
         track_data["co2s"] = co2s # generate_co2s(outputs)
 
         test_data.append(track_data)
 
     return test_data
 
+def map_permutations(pool, n_threads, chunksize, thread_data):
+    # Pool.imap hands results back in submission order as they finish, so times line up with the
+    # serial path and a writer can store each one without waiting for the rest
+    groups = lane_groups(thread_data, n_threads if pool is not None else 1)
+    if groups is not None:
+        logging.info("Solving %d permutations in %d lockstep groups" % (len(thread_data), len(groups)))
+        if pool is None:
+            grouped = (run_lanes(g) for g in groups)
+        else:
+            grouped = pool.imap(run_lanes, groups, 1)
+        return itertools.chain.from_iterable(grouped)
+
+    if pool is None:
+        return (run_permutation(d) for d in thread_data)
+
+    if chunksize is None:
+        chunksize = pool_chunksize(len(thread_data), n_threads)
+    logging.info("Mapping %d permutations in chunks of %d" % (len(thread_data), chunksize))
+
+    return pool.imap(run_permutation, thread_data, chunksize)
+
+def lane_groups(thread_data, n_threads):
+    """
+    thread_data cut into groups for a model that solves permutations in lockstep (see sims/lanes.py),
+    or None if it doesn't or no group would be wide enough to pay off. Consecutive permutations on
+    the same segments and dl are split evenly into groups of at most lanes.LANE_WIDTH. A run is cut
+    into more groups while that leaves each of n_threads workers a share of it, but not into groups
+    narrower than lanes.MIN_LANES; the pool then hands whole groups out to the workers.
+    """
+    if len(thread_data) == 0 or not thread_data[0][2].lockstep():
+        return None
+
+    runs = []
+    for d in thread_data:
+        last = runs[-1][-1] if len(runs) > 0 else None
+        if last is not None and d[5] is last[5] and d[6] == last[6]:
+            runs[-1].append(d)
+        else:
+            runs.append([d])
+
+    groups = []
+    for run in runs:
+        n = len(run)
+        share = int(np.ceil(n_threads * n / float(len(thread_data))))
+        count = min(max(int(np.ceil(n / float(lanes.LANE_WIDTH))), share), n // lanes.MIN_LANES)
+        count = max(count, 1)
+        bounds = [n * k // count for k in range(count + 1)]
+        groups.extend(run[bounds[k]:bounds[k+1]] for k in range(count))
+
+    if max(len(g) for g in groups) < lanes.MIN_LANES:
+        return None
+    return groups
+
+def pool_chunksize(n, n_threads):
+    # a few chunks per worker evens out permutations that take longer than others
+    return int(max(np.ceil(n / (4.0 * n_threads)), 1))
+
 def generateIndicies(contents):
     lens = [len(list(d.values())[0]) for d in contents]
     ints = [[i for i in range(x)] for x in lens]
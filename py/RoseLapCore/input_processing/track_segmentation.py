@@ -1,12 +1,15 @@
 from __future__ import print_function
 import numpy as np
 import math
+import os
 import itertools as it
 import time
 from svgpathtools import *
 from scipy import signal
 from scipy.interpolate import UnivariateSpline
 import json
+import hashlib
+from collections import OrderedDict
 import matplotlib.pyplot as plt
 
 epsilon = 1e-4
@@ -34,64 +37,169 @@ def sectors_dxf(dxf_output, connectivity, open_ended):
       # print('arc angle: %.2f direction = %.1f' % (arc_angle,shape[6]))
       length = shape[3]*math.radians(arc_angle)
       sectors.append(Sector(index, length, 1.0/shape[3]))
-  return sectors  
+  return TrackArrays([x.length for x in sectors], [x.curvature for x in sectors], [x.i for x in sectors], kind='sector')
+
+class EndpointGrid(object):
+  """
+  Entities bucketed by one endpoint on a grid of 2*epsilon cells, so every endpoint within
+  epsilon of a point (in both x and y) is in the 3x3 block of cells around it.
+  """
+  def __init__(self):
+    self.cells = {}
+    self.where = {}
+
+  def cell(self, x, y):
+    return (int(math.floor(x/(2*epsilon))), int(math.floor(y/(2*epsilon))))
+
+  def add(self, i, x, y):
+    c = self.cell(x, y)
+    self.cells.setdefault(c, set()).add(i)
+    self.where[i] = c
+
+  def remove(self, i):
+    if i in self.where:
+      self.cells[self.where.pop(i)].discard(i)
+
+  def near(self, x, y):
+    cx, cy = self.cell(x, y)
+    found = set()
+    for dx in (-1, 0, 1):
+      for dy in (-1, 0, 1):
+        found |= self.cells.get((cx+dx, cy+dy), set())
+    return found
+
+def dxf_pairs(f):
+  """
+  Yields the (group code, value) pairs of an open ASCII DXF file, both stripped, reading the
+  file one pair at a time.
+  """
+  for code in f:
+    yield (code.strip(), next(f, '').strip())
+
+def dxf_entities(pairs):
+  """
+  Groups DXF pairs into (entity type, [(code, value), ...]) for every 0 group, holding only
+  the entity being read.
+  """
+  kind = None
+  body = []
+  for code, value in pairs:
+    if code == '0':
+      if kind is not None:
+        yield (kind, body)
+      kind, body = value, []
+    else:
+      body.append((code, value))
+  if kind is not None:
+    yield (kind, body)
+
+def dxf_shapes(entities):
+  """
+  Turns DXF entities into load_dxf's shape lists:
+    ['line', x1, y1, x2, y2]
+    ['arc', xc, yc, radius, start_angle, end_angle, direction, x1, y1, x2, y2]
+  LINE, ARC and CIRCLE map directly; LWPOLYLINEs are split into a line per straight span and
+  a counterclockwise arc per bulged one.
+  """
+  for kind, body in entities:
+    if kind == 'LINE':
+      this_shape = ['line',0,0,0,0];
+      # x1 y1 x2 y2
+      headers = ['10','20','11','21']
+      for code, value in body:
+        if code in headers:
+          this_shape[headers.index(code)+1]=float(value)
+      yield this_shape
+    elif kind == 'ARC' or kind == 'CIRCLE':
+      this_shape = [0,0,0,0,0]
+      # xc yc radius start_angle end_angle
+      headers = ['10','20','40','50','51']
+      for code, value in body:
+        if code in headers:
+          this_shape[headers.index(code)]=float(value)
+      yield arc_shape(*this_shape)
+    elif kind == 'LWPOLYLINE':
+      for shape in lwpolyline_shapes(body):
+        yield shape
+
+def arc_shape(xc, yc, radius, start_angle, end_angle):
+  return ['arc', xc, yc, radius, start_angle, end_angle, 1,
+    math.cos(math.radians(start_angle))*radius+xc,
+    math.sin(math.radians(start_angle))*radius+yc,
+    math.cos(math.radians(end_angle))*radius+xc,
+    math.sin(math.radians(end_angle))*radius+yc]
+
+def lwpolyline_shapes(body):
+  vertices = [] # x y bulge
+  closed = False
+  for code, value in body:
+    if code == '10':
+      vertices.append([float(value),0,0])
+    elif code == '20' and len(vertices) > 0:
+      vertices[-1][1] = float(value)
+    elif code == '42' and len(vertices) > 0:
+      vertices[-1][2] = float(value)
+    elif code == '70':
+      closed = (int(value) & 1) == 1
+
+  spans = len(vertices) if closed else len(vertices)-1
+  for i in range(max(spans, 0)):
+    x1, y1, bulge = vertices[i]
+    x2, y2 = vertices[(i+1) % len(vertices)][:2]
+    if abs(bulge) < epsilon or (x1 == x2 and y1 == y2):
+      yield ['line', x1, y1, x2, y2]
+      continue
+    # the bulge is tan(included angle/4), positive going counterclockwise from this vertex
+    dx, dy = x2-x1, y2-y1
+    chord = math.hypot(dx, dy)
+    radius = chord*(1+bulge**2)/(4*abs(bulge))
+    offset = (1-bulge**2)/(4*bulge)
+    xc = (x1+x2)/2 - offset*dy
+    yc = (y1+y2)/2 + offset*dx
+    a1 = math.degrees(math.atan2(y1-yc, x1-xc))
+    a2 = math.degrees(math.atan2(y2-yc, x2-xc))
+    # DXF arcs run counterclockwise, so a clockwise span is stored end first
+    if bulge > 0:
+      yield arc_shape(xc, yc, radius, a1, a2)
+    else:
+      yield arc_shape(xc, yc, radius, a2, a1)
 
 def load_dxf(path_to_file):
   #print(path_to_file)
   with open(path_to_file,'r') as p:
-    
-    lines = [x.strip() for x in p.read().splitlines()]
-    connectivity = []
-    dxf_output = []
-    i=0
-    while i<len(lines):
-      if lines[i] == 'AcDbLine':
-        
-        this_shape = ['line',0,0,0,0];
-        # x1 y1 x2 y2
-        headers = ['10','20','11','21']
-        while i<len(lines):
-          if lines[i] in headers:
-            this_shape[headers.index(lines[i])+1]=float(lines[i+1])
-          elif lines[i] == '0':
-            break;
-          else:
-            i-=1
-          i+=2;
-        dxf_output.append(this_shape)
-      elif lines[i] == 'AcDbCircle':
-        this_shape = ['arc',0,0,0,0,0,1]
-        # xc yc radius start_angle end_angle direction x1 y1 x2 y2
-        headers = ['10','20','40','50','51']
-        while i<len(lines):
-          if lines[i] in headers:
-            this_shape[headers.index(lines[i])+1]=float(lines[i+1])
-          elif lines[i] == '0':
-            break;
-          else:
-            i-=1
-          i+=2;
-        this_shape.append(math.cos(math.radians(this_shape[4]))*this_shape[3]+this_shape[1])
-        this_shape.append(math.sin(math.radians(this_shape[4]))*this_shape[3]+this_shape[2])
-        this_shape.append(math.cos(math.radians(this_shape[5]))*this_shape[3]+this_shape[1])
-        this_shape.append(math.sin(math.radians(this_shape[5]))*this_shape[3]+this_shape[2])
-        dxf_output.append(this_shape)
-      i+=1
+    dxf_output = list(dxf_shapes(dxf_entities(dxf_pairs(p))))
 
     connectivity = []
     #[print(x) for x in dxf_output]
 
     first_time = True
     hop = [0,0];
+    placed = set()
+    starts, ends = EndpointGrid(), EndpointGrid()
+    for i, shape in enumerate(dxf_output):
+      starts.add(i, shape[-4], shape[-3])
+      ends.add(i, shape[-2], shape[-1])
+
+    def place(i):
+      connectivity.append(i)
+      placed.add(i)
+      starts.remove(i)
+      ends.remove(i)
+
     if len(dxf_output) == 1:
       connectivity = [0]
     else:
       while len(connectivity) < len(dxf_output):
         matches_pos = []
         matches_neg = []
-        for i in range(len(dxf_output)):
+        if first_time or len(connectivity) >= len(dxf_output)-1:
+          # the start and the closing entity (which may match one already placed) get a full scan
+          candidates = range(len(dxf_output))
+        else:
+          candidates = sorted(starts.near(hop[0], hop[1]) | ends.near(hop[0], hop[1]))
+        for i in candidates:
           if len(connectivity) < len(dxf_output)-1:
-            if i in connectivity:
+            if i in placed:
               continue
           elif i == connectivity[-1]:
             continue
@@ -104,12 +212,12 @@ def load_dxf(path_to_file):
           fine = False
           for mp in matches_pos:
             if dxf_output[mp][-2] > dxf_output[mp][-1]:
-              connectivity.append(mp)
+              place(mp)
               hop = dxf_output[mp][-2:]
               fine = True
           for mn in matches_neg:
             if dxf_output[mn][-4] > dxf_output[mn][-3]:
-              connectivity.append(mn)
+              place(mn)
               temp = dxf_output[mn][-2:]
               dxf_output[mn][-2:] = dxf_output[mn][-4:-2]
               dxf_output[mn][-4:-2] = temp
@@ -120,10 +228,10 @@ def load_dxf(path_to_file):
           if fine:
             continue
         if len(matches_pos) > 0:
-          connectivity.append(matches_pos[0])
+          place(matches_pos[0])
           hop = dxf_output[matches_pos[0]][-2:]
         else:
-          connectivity.append(matches_neg[0])
+          place(matches_neg[0])
           temp = dxf_output[matches_neg[0]][-2:]
           dxf_output[matches_neg[0]][-2:] = dxf_output[matches_neg[0]][-4:-2]
           dxf_output[matches_neg[0]][-4:-2] = temp
@@ -174,24 +282,22 @@ def pointify_dxf(dxf_output, connectivity, dl):
       intermediates.append(len(pts))
   return (np.array(pts),intermediates)
 
-def points_in_each_seg_slow(path, dx, plot, opts={}):
-  a = np.array([])
-  s = np.array([])
-  k = np.array([])
-  d = np.array([])
-  l = np.array([0])
-  firsttime = True
+def points_in_each_seg(path, dx, plot, opts={}):
+  counts = [max(int(seg.length()/dx)-1, 0) for seg in path]
+  a = np.empty(sum(counts), dtype=complex)
+  k = np.empty(sum(counts))
+  s = np.empty(sum(counts))
   sectors = []
-  for seg in path:
-    ls = np.linspace(0,1,seg.length()/dx)[:-1]
-    x = seg.poly()(ls)
-    for i in ls:
-      k = np.append(k, seg.curvature(i))
-    a = np.append(a, x)
-    s = np.append(s, np.ones_like(x)*len(sectors))
-    sectors.append(a.shape[0])
-  for i in range(1,len(a)):
-    l = np.append(l, l[-1]+math.hypot(a.real[i]-a.real[i-1],-a.imag[i]+a.imag[i-1]))
+  start = 0
+  for seg, n in zip(path, counts):
+    ls = np.linspace(0,1,n+1)[:-1]
+    a[start:start+n] = seg.poly()(ls)
+    k[start:start+n] = curvature_samples(seg, ls)
+    s[start:start+n] = len(sectors)
+    start += n
+    sectors.append(start)
+  l = np.zeros(a.shape[0])
+  np.cumsum(np.hypot(np.diff(a.real), np.diff(a.imag)), out=l[1:])
   # print(k)
   smoothing = opts['smoothing'] if 'smoothing' in opts else 0.005
   smoothing_dof = opts['smoothing_dof'] if 'smoothing_dof' in opts else 2
@@ -204,7 +310,28 @@ def points_in_each_seg_slow(path, dx, plot, opts={}):
     plt.plot(l,k,'.')
     plt.plot(lsp,knew, lw=2)
 
-  return (np.stack((a.real,-a.imag,knew,s.real),axis=1),sectors)
+  return (np.stack((a.real,-a.imag,knew,s),axis=1),sectors)
+
+def curvature_samples(seg, ts):
+  """
+  seg.curvature at every t in ts. Bezier segments are evaluated all at once with svgpathtools'
+  formula; samples where the tangent vanishes (0/0), and other segment types, fall back to
+  seg.curvature one t at a time.
+  """
+  if isinstance(seg, Line):
+    return np.zeros(len(ts))
+  if not isinstance(seg, (QuadraticBezier, CubicBezier)):
+    return np.array([seg.curvature(t) for t in ts], dtype=float)
+
+  dz = seg.derivative(ts)
+  ddz = seg.derivative(ts, n=2)
+  dx, dy = dz.real, dz.imag
+  ddx, ddy = ddz.real, ddz.imag
+  with np.errstate(invalid='ignore', divide='ignore'):
+    kappa = abs(dx*ddy - dy*ddx)/np.sqrt(dx*dx + dy*dy)**3
+  for i in np.flatnonzero(np.isnan(kappa)):
+    kappa[i] = seg.curvature(ts[i])
+  return kappa
 
 class Sector:
     def __init__(self, i, length, curvature):
@@ -259,6 +386,81 @@ class RLT(object):
     self.curvature = k
     self.length = l
     self.sector = s
+
+class SegmentView(object):
+  """
+  One point of a TrackArrays, with the attributes the sims read off Segment, Sector and RLT.
+  """
+  __slots__ = ('length', 'curvature', 'sector', 'x', 'y')
+
+  def __init__(self, length, curvature, sector, x, y):
+    self.length, self.curvature, self.sector, self.x, self.y = length, curvature, sector, x, y
+
+  @property
+  def i(self):
+    return self.sector
+
+  def __repr__(self):
+    return "SegmentView(%d, %.1f, %.3f)" % (self.sector,self.length,self.curvature)
+
+class TrackArrays(object):
+  """
+  Struct-of-arrays form of a segmented track: a contiguous column per field instead of an object
+  per point. kind records what the loader produced ('segment', 'sector' or 'rlt'); for sectors
+  the sector column holds the DXF entity index (Sector.i), and x/y are zero where the loader has
+  no coordinates. Indexing and iteration hand out SegmentViews, so code written against lists of
+  Segments keeps working, while vectorized code can use the columns directly.
+  Views aren't kept on the track, which the segment memo shares between studies. Whoever hands a
+  track to the sims builds its views() once and passes those (see batcher and segment_store).
+  """
+  def __init__(self, length, curvature, sector, x=None, y=None, kind='segment'):
+    self.length = np.ascontiguousarray(length, dtype=np.float64)
+    self.curvature = np.ascontiguousarray(curvature, dtype=np.float64)
+    self.sector = np.ascontiguousarray(np.broadcast_to(sector, self.length.shape), dtype=np.int32)
+    self.x = np.zeros(self.length.shape) if x is None else np.ascontiguousarray(x, dtype=np.float64)
+    self.y = np.zeros(self.length.shape) if y is None else np.ascontiguousarray(y, dtype=np.float64)
+    self.kind = kind
+
+  @staticmethod
+  def from_segments(segments, kind='segment'):
+    return TrackArrays([s.length for s in segments], [s.curvature for s in segments], [s.sector for s in segments],
+      [s.x for s in segments], [s.y for s in segments], kind)
+
+  @staticmethod
+  def from_columns(columns, kind):
+    return TrackArrays(columns[:,C_LENGTH], columns[:,C_CURVATURE], columns[:,C_SECTOR], columns[:,C_X], columns[:,C_Y], kind)
+
+  def columns(self):
+    """
+    All fields as one float64 (n x C_COLS) array, for storing; from_columns undoes it.
+    """
+    columns = np.empty((len(self), C_COLS))
+    columns[:,C_LENGTH] = self.length
+    columns[:,C_CURVATURE] = self.curvature
+    columns[:,C_SECTOR] = self.sector
+    columns[:,C_X] = self.x
+    columns[:,C_Y] = self.y
+    return columns
+
+  def views(self):
+    # every point, as python floats, since the sims read single points in their hot loops; a tuple, as
+    # one set of views is shared by every solve on the track
+    return tuple([SegmentView(*row) for row in zip(self.length.tolist(), self.curvature.tolist(),
+      self.sector.tolist(), self.x.tolist(), self.y.tolist())])
+
+  def __len__(self):
+    return len(self.length)
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return TrackArrays(self.length[i], self.curvature[i], self.sector[i], self.x[i], self.y[i], self.kind)
+    return SegmentView(self.length[i].item(), self.curvature[i].item(), self.sector[i].item(), self.x[i].item(), self.y[i].item())
+
+  def __iter__(self):
+    return iter(self.views())
+
+  def __repr__(self):
+    return "TrackArrays(%d %ss, %.1f long)" % (len(self), self.kind, np.sum(self.length))
     
 def seg_points_trackwalker(fn,dx,plot=False,opts={}):
   f = open(fn,'r')
@@ -277,22 +479,17 @@ def seg_points_trackwalker(fn,dx,plot=False,opts={}):
   x1 = x1-x1[0]
   x2 = x2-x2[0]
 
-  k = np.zeros(x1.shape,dtype=float)
-  d = np.zeros(x1.shape,dtype=float)
-  l = np.zeros(x1.shape,dtype=float)
-  theta = np.zeros(x1.shape,dtype=float)
-  x = np.zeros(x1.shape,dtype=float)
-  y = np.zeros(x1.shape,dtype=float)
-
   D = (opts["D"] if "D" in opts else params["D"])/12.0
 
-  for i in range(1,np.size(x1)):
-    d[i] = (x1[i]-x1[i-1]+x2[i]-x2[i-1])/2
-    k[i] = 2/D *(x1[i]-x1[i-1]-x2[i]+x2[i-1])/(x1[i]-x1[i-1]+x2[i]-x2[i-1])
-    theta[i] = theta[i-1] + d[i]*k[i]
-    x[i] = x[i-1] + math.sin(theta[i])*d[i]
-    y[i] = y[i-1] + math.cos(theta[i])*d[i]
-    l[i] = l[i-1] + d[i]
+  # wheel travel and curvature from the encoder increments, then dead-reckon the path
+  dx1 = x1[1:]-x1[:-1]
+  dx2 = x2[1:]-x2[:-1]
+  d = np.concatenate(([0.0], (dx1+x2[1:]-x2[:-1])/2))
+  k = np.concatenate(([0.0], 2/D *(dx1-x2[1:]+x2[:-1])/(dx1+x2[1:]-x2[:-1])))
+  theta = np.cumsum(d*k)
+  x = np.cumsum(np.sin(theta)*d)
+  y = np.cumsum(np.cos(theta)*d)
+  l = np.cumsum(d)
 
   l=l[1:]*np.sign(np.sum(l))
   k=np.clip(k[1:], -params["maxcurv"], params["maxcurv"])
@@ -312,72 +509,28 @@ def seg_points_trackwalker(fn,dx,plot=False,opts={}):
     plt.plot(l,k,'-',lw=1)
   spl = UnivariateSpline(l, k, k=smoothing_dof)
   spl.set_smoothing_factor(smoothing)
-  lsp = np.linspace(min(l),max(l), l_tot/dx)
+  lsp = np.linspace(min(l),max(l), int(l_tot/dx))
   k = spl(lsp)
   l = lsp
   if plot:
     plt.plot(lsp,k, lw=2)
     plt.title('Filtered l-k')
 
-  d = np.zeros(l.shape,dtype=float)
-  theta = np.zeros(l.shape,dtype=float)
-  xf = np.zeros(l.shape,dtype=float)
-  yf = np.zeros(l.shape,dtype=float)
-  for i in range(1,np.size(l)):
-    d[i] = (l[i]-l[i-1])
-    theta[i] = theta[i-1] + d[i]*k[i]
-    xf[i] = xf[i-1] + math.sin(theta[i])*d[i]
-    yf[i] = yf[i-1] + math.cos(theta[i])*d[i]
+  d = np.concatenate(([0.0], np.diff(l)))
+  theta = np.cumsum(d*k)
+  xf = np.cumsum(np.sin(theta)*d)
+  yf = np.cumsum(np.cos(theta)*d)
   if plot:
     plt.figure()
     plt.plot(x,y,'.b',ms=1)
     plt.plot(xf,yf,'.r',ms=2)
-  segs = []
-  for i in range(len(k)):
-    segs.append(Segment(0,0, xf[i],yf[i], 0,0, 0,False,dx,abs(k[i])))
-
-  return segs
+  return TrackArrays(np.full(len(k), dx), np.minimum(np.abs(k), 0.05), 0, xf, yf)
 
 
 def seg_points(points,intermediates,open_ended):
-  segs=[]
-  for i in range(points.shape[0]):
-    overk = False
-    im=i-1
-    if im < 0:
-      im = points.shape[0]-1
-      if open_ended:
-        overk = True
-        im = 0
-    ip=i+1
-    if ip >= points.shape[0]:
-      ip = 0
-      if open_ended:
-        overk = True
-        ip = i
-    segs.append(Segment(points[im,0], points[im,1], points[i,0], points[i,1], points[ip,0], points[ip,1], points[i,2], overk))
-  for i in intermediates:
-    #print (segs[i-1].curvature, segs[i].curvature, segs[i-1].curvature)
-    segs[i].curvature = (segs[i-1].curvature+segs[i+1].curvature)/2
-  return segs
+  return segment_points(points[:,0], points[:,1], points[:,2], open_ended, intermediates=intermediates)
 
 def seg_points_svg(points,open_ended):
-  segs=[]
-  for i in range(points.shape[0]):
-    overk = False
-    im=i-1
-    if im < 0:
-      im = points.shape[0]-1
-      if open_ended:
-        overk = True
-        im = 0
-    ip=i+1
-    if ip >= points.shape[0]:
-      ip = 0
-      if open_ended:
-        overk = True
-        ip = i
-    segs.append(Segment(points[im,0], points[im,1], points[i,0], points[i,1], points[ip,0], points[ip,1], points[i,3], overk, curvature=points[i,2]))
   # for i in range(1,len(segs)-1):
   #   d1 = segs[i].curvature-segs[i-1].curvature
   #   d2 = segs[i].curvature-segs[i+1].curvature
@@ -385,7 +538,51 @@ def seg_points_svg(points,open_ended):
   #   if d1 > 0.005 and d2 > 0.005:
   #     segs[i].curvature = (segs[i-1].curvature+segs[i+1].curvature)/2
 
-  return segs
+  return segment_points(points[:,0], points[:,1], points[:,3], open_ended, curvature=points[:,2])
+
+def segment_points(x, y, sector, open_ended, curvature=None, intermediates=[]):
+  """
+  Does what building a Segment per point did, for the whole point array at once: neighbour and
+  secant lengths, Heron's-formula curvature (zero at the ends of an open track), the optional
+  curvature override, the 0.05 clamp and the averaging across shape boundaries. Every value goes
+  through the same floating point operations in the same order as Segment, so the result is
+  bit-for-bit the same.
+  """
+  n = len(x)
+  im = np.arange(n) - 1
+  ip = np.arange(n) + 1
+  endpoint = np.zeros(n, dtype=bool)
+  if n > 0:
+    im[0], ip[-1] = n-1, 0
+    if open_ended:
+      im[0], ip[-1] = 0, n-1
+      endpoint[0] = endpoint[-1] = True
+
+  length_m = hypot(x[im]-x, y[im]-y)
+  length_p = hypot(x[ip]-x, y[ip]-y)
+  length_secant = hypot(x[ip]-x[im], y[ip]-y[im])
+  length = (length_m+length_p)/2
+
+  if curvature is None:
+    with np.errstate(invalid='ignore', divide='ignore'):
+      p = (length_m+length_p+length_secant)/2
+      heron = p*(p-length_m)*(p-length_p)*(p-length_secant)
+      area = np.sqrt(np.where(heron < 0, 0, heron))
+      curvature = 4*area/(length_m*length_p*length_secant)
+    curvature[(length_m <= 0) | (length_p <= 0) | endpoint] = 0
+  else:
+    curvature = np.array(curvature, dtype=np.float64)
+  curvature[curvature > 0.05] = 0.05
+
+  # in order, since neighbouring boundaries see each other's averages
+  for i in intermediates:
+    curvature[i] = (curvature[i-1]+curvature[i+1])/2
+
+  return TrackArrays(length, curvature, sector, x, y)
+
+def hypot(dx, dy):
+  # elementwise math.hypot; np.hypot rounds differently in the last bit now and then
+  return np.fromiter(map(math.hypot, dx.tolist(), dy.tolist()), dtype=np.float64, count=len(dx))
 
 def plot_segments(segments):
   plt.figure()
@@ -411,6 +608,32 @@ def plot_segments(segments):
   plt.show()
 
 def file_to_segments(filename, dl, plot=False, opts={}, sectors_only=False):
+  """
+  Segments a track file, reusing an earlier segmentation of the same file contents, dl, opts and
+  sectors_only when there is one (see set_segment_cache_dir for the on-disk tier). Plotting runs
+  always segment from scratch.
+  """
+  if plot:
+    return segment_file(filename, dl, plot, opts, sectors_only)
+
+  key = segment_key(filename, dl, opts, sectors_only)
+  if key in segment_memo:
+    segment_memo[key] = segment_memo.pop(key)
+    return segment_memo[key]
+
+  segments = load_cached_segments(key)
+  if segments is None:
+    segments = segment_file(filename, dl, plot, opts, sectors_only)
+    if segments is not None:
+      save_cached_segments(key, segments)
+
+  if segments is not None:
+    segment_memo[key] = segments
+    while len(segment_memo) > MAX_MEMO:
+      segment_memo.popitem(last=False)
+  return segments
+
+def segment_file(filename, dl, plot=False, opts={}, sectors_only=False):
   if sectors_only:
     dxf_geometry,connectivity,open_ended = load_dxf(filename)
     return sectors_dxf(dxf_geometry,connectivity,open_ended)
@@ -422,15 +645,77 @@ def file_to_segments(filename, dl, plot=False, opts={}, sectors_only=False):
     testpath,attrs = svg2paths(filename) 
     # print(testpath)
     testpath = testpath[0]
-    pts,sectors = points_in_each_seg_slow(testpath, dl, plot, opts)
+    pts,sectors = points_in_each_seg(testpath, dl, plot, opts)
     return seg_points_svg(pts, max(abs(pts[0,:]-pts[-1,:])) > epsilon)
   elif filename[-4:].lower() == '.log':
     return seg_points_trackwalker(filename, dl, plot, opts)
   elif filename[-4:].lower() == '.rlt':
-    return rlt_to_segments(filenam, opts)
+    return rlt_to_segments(filename, opts)
   else:
     return None
 
+# Segmentations already made in this process, most recently used last
+segment_memo = OrderedDict()
+MAX_MEMO = 16
+
+# Directory of the persistent .npz tier; None keeps the cache in memory only
+segment_cache_dir = None
+
+def set_segment_cache_dir(directory):
+  global segment_cache_dir
+  if directory is not None and not os.path.isdir(directory):
+    os.makedirs(directory)
+  segment_cache_dir = directory
+
+def segment_key(filename, dl, opts, sectors_only):
+  # sectors come straight from the DXF entities, so dl and opts don't change them
+  if sectors_only:
+    dl, opts = None, {}
+  h = hashlib.md5()
+  h.update(file_hash(filename).encode())
+  h.update(repr((filename[-4:].lower(), dl, sorted(opts.items()), bool(sectors_only))).encode())
+  return h.hexdigest()
+
+def load_cached_segments(key):
+  if segment_cache_dir is None:
+    return None
+  try:
+    with np.load(os.path.join(segment_cache_dir, key + '.npz')) as f:
+      return TrackArrays.from_columns(f['columns'], str(f['kind']))
+  except (IOError, OSError, KeyError, ValueError):
+    return None
+
+def save_cached_segments(key, segments):
+  if segment_cache_dir is None:
+    return
+  fn = os.path.join(segment_cache_dir, key + '.npz')
+  tmp = "%s.%d.tmp" % (fn, os.getpid())
+  try:
+    with open(tmp, 'wb') as f:
+      np.savez(f, columns=segments.columns(), kind=segments.kind)
+    os.replace(tmp, fn)
+  except (IOError, OSError):
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+def file_hash(filename):
+  """
+  MD5 of a track file's contents, for keying anything derived from the track.
+  """
+  h = hashlib.md5()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+# Columns of TrackArrays.columns(), the single-array form of a track for storing
+C_LENGTH = 0
+C_CURVATURE = 1
+C_SECTOR = 2
+C_X = 3
+C_Y = 4
+C_COLS = 5
+
 def rlt_to_segments(filename, opts={}):
   with open(filename, "r") as rlt:
     segs = []
@@ -444,7 +729,7 @@ def rlt_to_segments(filename, opts={}):
       for j in range(n):
         segs.append(RLT(k, l, i))
 
-  return segs
+  return TrackArrays([x.length for x in segs], [x.curvature for x in segs], [x.sector for x in segs], kind='rlt')
 
 if __name__ == '__main__':
   import sys
@@ -1,16 +1,83 @@
 import fancyyaml as yaml
 import numpy as np
 import math
+import bisect
 from math import sqrt
+import sims # puts the sims directory on the path, as ip_logic relies on too
+from corner_arrays import square
 
 g = 32.2 # ft/s^2
 
+# Fields each table prep() builds is taken from; setting any of them drops the table until it's rebuilt
+ENGINE_FIELDS = ('transmission_type', 'engine_rpms', 'engine_torque', 'gears')
+AERO_FIELDS = ('downforce_35mph', 'drag_35mph')
+
+class EngineTable(object):
+  """
+  The parts of the engine and transmission eng_force looks up on every call, taken from the vehicle
+  once. The torque curve is searched by bisection instead of scanned, and the CVT's peak power point
+  is found up front. The arithmetic stays eng_force's own, in the same order, so forces and gears
+  come out the same to the last bit.
+  """
+  def __init__(self, vehicle):
+    # engine_rpms ascending, as the scan took it; any torque past the last rpm has no rpm to go with
+    self.rpms = list(vehicle.engine_rpms)
+    self.torque = list(vehicle.engine_torque[:len(self.rpms)])
+
+    self.cvt = vehicle.transmission_type.lower() == 'cvt'
+    if self.cvt:
+      eng_power = [self.torque[i]*self.rpms[i] for i in range(len(self.torque))]
+      self.eng_torque = self.torque[eng_power.index(max(eng_power))]
+      self.crank_rpm  = self.rpms  [eng_power.index(max(eng_power))]
+      return
+
+    self.rpm_array = np.array(self.rpms, dtype=np.float64)
+    self.torque_array = np.array(self.torque, dtype=np.float64)
+    self.gears = np.array(vehicle.gears, dtype=np.float64)
+
+class AeroTable(object):
+  """
+  Downforce and drag per v**2 in each aero mode, scaled from the 35 mph figures once, and which
+  modes are no different from full aero (mode 0).
+  """
+  def __init__(self, vehicle):
+    self.downforce = [f / (51.33333 ** 2) for f in vehicle.downforce_35mph]
+    self.drag = [f / (51.33333 ** 2) for f in vehicle.drag_35mph]
+    self.same_as_full = [self.downforce[m] == self.downforce[0] and self.drag[m] == self.drag[0] for m in range(len(self.downforce))]
+
 class Vehicle(object):
+  def __setattr__(self, name, value):
+    if name in ENGINE_FIELDS:
+      self.__dict__.pop('_engine', None)
+    if name in AERO_FIELDS:
+      self.__dict__.pop('_aero', None)
+    object.__setattr__(self, name, value)
+
+  def engine(self):
+    # the EngineTable from prep(), built again if a field it came from has been set since
+    if '_engine' not in self.__dict__:
+      self._engine = EngineTable(self)
+    return self._engine
+
+  def aero(self):
+    # the AeroTable from prep(), likewise
+    if '_aero' not in self.__dict__:
+      self._aero = AeroTable(self)
+    return self._aero
+
   def downforce(self, v, aero_mode):
-    return self.downforce_35mph[aero_mode] / (51.33333 ** 2) * v**2
+    return self.aero().downforce[aero_mode] * v**2
 
   def drag(self, v, aero_mode):
-    return self.drag_35mph[aero_mode] / (51.33333 ** 2) * v**2
+    return self.aero().drag[aero_mode] * v**2
+
+  def aero_matters(self, v, aero_mode):
+    # whether aero_mode moves downforce or drag at v from full aero by 1e-3 or more
+    aero = self.aero()
+    if aero.same_as_full[aero_mode]:
+      return False
+    v2 = v**2
+    return not (abs(aero.downforce[aero_mode]*v2 - aero.downforce[0]*v2) < 1e-3 and abs(aero.drag[aero_mode]*v2 - aero.drag[0]*v2) < 1e-3)
 
   def front_brake_bias(self):
     return self.brake_bias
@@ -19,48 +86,95 @@ class Vehicle(object):
     return 1 - self.brake_bias
 
   def eng_force(self, vel, gear):
-    if self.transmission_type.lower() == 'cvt':
-      eng_power = [self.engine_torque[i]*self.engine_rpms[i] for i in range(len(self.engine_torque))]
-      eng_torque = self.engine_torque[eng_power.index(max(eng_power))]
-      crank_rpm  = self.engine_rpms  [eng_power.index(max(eng_power))]
+    engine = self.engine()
+    if engine.cvt:
       cvt_ratio = np.inf
       if vel > 0:
-        cvt_ratio = crank_rpm/(vel / self.rear_tire_radius * 9.5493)
-      return (cvt_ratio*eng_torque*self.transmission_efficiency, crank_rpm)
+        cvt_ratio = engine.crank_rpm/(vel / self.rear_tire_radius * 9.5493)
+      return (cvt_ratio*engine.eng_torque*self.transmission_efficiency, engine.crank_rpm)
     else:
       # Compute the angular speed of the crankshaft. 9.5493 is a conversion factor from rad/s to RPM.
       gear_ratio = self.gears[gear]
       eng_output_rpm = vel / self.rear_tire_radius * 9.5493 * self.final_drive_reduction
       crank_rpm = eng_output_rpm * self.engine_reduction * gear_ratio
 
-      if crank_rpm <= self.engine_rpms[0]:
+      rpms = engine.rpms
+      if crank_rpm <= rpms[0]:
         # If under RPM range, use the lowest torque value
-        return (self.engine_torque[0] * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.front_tire_radius *self.transmission_efficiency, crank_rpm)
-      elif crank_rpm > self.engine_rpms[-1]:
+        return (engine.torque[0] * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.front_tire_radius *self.transmission_efficiency, crank_rpm)
+      elif crank_rpm > rpms[-1]:
         # If over RPM range, no power because you're hitting the rev limiter
         return (0,crank_rpm)
       else:
-        # Otherwise, linearly interpolate
-        for i in range(1, len(self.engine_rpms)):
-          if crank_rpm < self.engine_rpms[i]:
-            torque = self.engine_torque[i] + (crank_rpm - self.engine_rpms[i]) * (self.engine_torque[i-1] - self.engine_torque[i]) / (self.engine_rpms[i-1] - self.engine_rpms[i])
-            return (torque * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.rear_tire_radius *self.transmission_efficiency, crank_rpm)
+        # Otherwise, linearly interpolate from the first rpm above crank_rpm
+        i = bisect.bisect_right(rpms, crank_rpm)
+        if i < len(rpms):
+          torque = engine.torque[i] + (crank_rpm - rpms[i]) * (engine.torque[i-1] - engine.torque[i]) / (rpms[i-1] - rpms[i])
+          return (torque * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.rear_tire_radius *self.transmission_efficiency, crank_rpm)
       return (0,crank_rpm)
 
+  def eng_force_array(self, vel, gear):
+    # eng_force for arrays of velocities and gears (broadcast together)
+    engine = self.engine()
+    vel = np.asarray(vel, dtype=np.float64)
+    if engine.cvt:
+      with np.errstate(divide='ignore'):
+        cvt_ratio = np.where(vel > 0, engine.crank_rpm/(vel / self.rear_tire_radius * 9.5493), np.inf)
+      return (cvt_ratio*engine.eng_torque*self.transmission_efficiency, np.full(cvt_ratio.shape, engine.crank_rpm, dtype=np.float64))
+
+    gear_ratio = engine.gears[gear]
+    eng_output_rpm = vel / self.rear_tire_radius * 9.5493 * self.final_drive_reduction
+    crank_rpm = eng_output_rpm * self.engine_reduction * gear_ratio
+
+    rpms = engine.rpm_array
+    torques = engine.torque_array
+    i = np.clip(np.searchsorted(rpms, crank_rpm, side='right'), 1, len(rpms)-1)
+    torque = torques[i] + (crank_rpm - rpms[i]) * (torques[i-1] - torques[i]) / (rpms[i-1] - rpms[i])
+    force = torque * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.rear_tire_radius *self.transmission_efficiency
+    low = torques[0] * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.front_tire_radius *self.transmission_efficiency
+    force = np.where(crank_rpm <= rpms[0], low, np.where(crank_rpm < rpms[-1], force, 0.0))
+    return (force, crank_rpm)
+
   def best_gear(self, v, fr_limit):
-    if self.transmission_type.lower() == 'cvt':
+    engine = self.engine()
+    if engine.cvt:
       return 0
     # Find the best gear and return the number for it.
     # Doesn't actually do anything with the friction limitation. It did at one point.
-    opts = [self.eng_force(v, int(gear))[0] for gear in range(len(self.gears))]
+    # eng_force for each gear, with what doesn't depend on the gear worked out once
+    eng_output_rpm = v / self.rear_tire_radius * 9.5493 * self.final_drive_reduction
+    rpms = engine.rpms
+    torques = engine.torque
     best = 0
     besti = -1
-    for i in range(len(opts)):
-      if opts[i] >= best:
-        best = opts[i]
-        besti = i
+    for gear, gear_ratio in enumerate(self.gears):
+      crank_rpm = eng_output_rpm * self.engine_reduction * gear_ratio
+      if crank_rpm <= rpms[0]:
+        force = torques[0] * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.front_tire_radius *self.transmission_efficiency
+      else:
+        i = bisect.bisect_right(rpms, crank_rpm)
+        if crank_rpm > rpms[-1] or i >= len(rpms):
+          force = 0
+        else:
+          torque = torques[i] + (crank_rpm - rpms[i]) * (torques[i-1] - torques[i]) / (rpms[i-1] - rpms[i])
+          force = torque * self.engine_reduction * gear_ratio * self.final_drive_reduction / self.rear_tire_radius *self.transmission_efficiency
+      if force >= best:
+        best = force
+        besti = gear
     return besti
 
+  def best_gear_array(self, v):
+    # best_gear for an array of velocities: the highest gear giving the most force, -1 if none gives any
+    v = np.asarray(v, dtype=np.float64)
+    if self.engine().cvt:
+      return np.zeros(v.shape, dtype=int)
+    n_gears = len(self.engine().gears)
+    opts = self.eng_force_array(v[..., np.newaxis], np.arange(n_gears))[0]
+    opts = np.where(np.isnan(opts), -np.inf, opts)
+    best = opts.max(axis=-1)
+    besti = n_gears - 1 - np.argmax((opts == best[..., np.newaxis])[..., ::-1], axis=-1)
+    return np.where(best >= 0, besti, -1)
+
   def f_lat_remain(self, n_tires, f_norm, f_long, front=None):
     if f_norm <= 0.0:
       return (0.0, 0.0)
@@ -137,7 +251,62 @@ class Vehicle(object):
 
     return (f_long,f_x_max)
 
+  def tire_limits_array(self, f_norm, front=None):
+    # (f_x_max, f_y_max) of tires carrying f_norm each, for the combined (None), front or rear tires
+    if front is None:
+      return (self.comb_tire_mu_x*f_norm + self.comb_tire_offset_x, self.comb_tire_mu_y*f_norm + self.comb_tire_offset_y)
+    elif front:
+      return (self.front_tire_mu_x*f_norm + self.front_tire_offset_x, self.front_tire_mu_y*f_norm + self.front_tire_offset_y)
+    return (self.rear_tire_mu_x*f_norm + self.rear_tire_offset_x, self.rear_tire_mu_y*f_norm + self.rear_tire_offset_y)
+
+  # The *_array versions of the grip methods take arrays of loads and give arrays back, element for
+  # element what the scalar method would return, down to the last bit.
+
+  def f_lat_remain_array(self, n_tires, f_norm, f_long, front=None):
+    f_norm = np.asarray(f_norm, dtype=np.float64)
+    f_long = np.asarray(f_long, dtype=np.float64)
+    f_x_max, f_y_max = self.tire_limits_array(f_norm/n_tires, front)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      f_lat = np.sqrt(np.maximum(1-square(np.abs(f_long)/n_tires)/f_x_max/f_x_max, 0))*f_y_max
+    f_lat = np.where(f_x_max < np.abs(f_long/n_tires), -np.inf, f_lat*n_tires)
+    unloaded = f_norm <= 0.0
+    return (np.where(unloaded, 0.0, f_lat), np.where(unloaded, 0.0, f_y_max*n_tires))
+
+  def f_long_remain_array(self, n_tires, f_norm, f_lat, front=None):
+    f_norm = np.asarray(f_norm, dtype=np.float64)
+    f_lat = np.asarray(f_lat, dtype=np.float64)
+    f_x_max, f_y_max = self.tire_limits_array(f_norm/n_tires, front)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      f_long = np.sqrt(np.maximum(1-square(np.abs(f_lat)/n_tires)/f_y_max/f_y_max, 0))*f_x_max
+    f_long = np.where(f_y_max < np.abs(f_lat/n_tires), -np.inf, f_long*n_tires)
+    unloaded = f_norm <= 0.0
+    return (np.where(unloaded, 0.0, f_long), np.where(unloaded, 0.0, f_x_max*n_tires))
+
+  def f_long_remain_pair_array(self, f_norm, f_lat, front=None):
+    # f_norm is a pair of arrays, one per tire; so are both lists given back
+    f_norm = [np.asarray(N, dtype=np.float64) for N in f_norm]
+    f_lat = np.abs(np.asarray(f_lat, dtype=np.float64))
+    eps = 1e-4
+    f_x_max = []
+    f_y_max = []
+    for N in f_norm:
+      f_x, f_y = self.tire_limits_array(N, front)
+      clamp = (N <= eps) | (f_x <= eps) | (f_y <= eps)
+      f_x_max.append(np.where(clamp, eps, f_x))
+      f_y_max.append(np.where(clamp, eps, f_y))
+
+    # the tire with less load takes its share of f_lat, the other one the rest
+    with np.errstate(divide='ignore', invalid='ignore'):
+      share = f_lat*np.where(f_norm[0] > f_norm[1], f_norm[1], f_norm[0])/(f_norm[0]+f_norm[1])
+      f_y = [np.where(f_norm[0] > f_norm[1], f_lat-share, share), np.where(f_norm[0] > f_norm[1], share, f_lat-share)]
+      f_long = [f_x_max[i]*np.sqrt(np.maximum(1-square(f_y[i])/square(f_y_max[i]), 0.0)) for i in range(2)]
+
+    sliding = (f_y_max[0] + f_y_max[1]) < f_lat
+    return ([np.where(sliding, -np.inf, f) for f in f_long], f_x_max)
+
   def prep(self):
+    self._engine = EngineTable(self)
+    self._aero = AeroTable(self)
     self.vmax = self.engine_rpms[-1]/self.gears[-1]/self.engine_reduction/9.5493/self.final_drive_reduction*self.rear_tire_radius
 
     self.mass = self.mass / self.g
@@ -147,6 +316,10 @@ class Vehicle(object):
     self.g = g
     self.__dict__.update(v_OBJ.__dict__)
 
+  def parameters(self):
+    # the vehicle's own fields, as a fresh dict, without the tables engine(), aero() and prep() build
+    return dict((k, v) for k, v in self.__dict__.items() if k[:1] != '_')
+
 def v_load(filename):
   vehicle_YAML = './params/vehicles/' + filename
   with open(vehicle_YAML) as data:
@@ -1,27 +1,326 @@
 # import shelve
 import _pickle as pickle
+import numpy as np
+import json
+import mmap
+import struct
 import time
 import os
-	
+
+"""
+Result files. pack() and ResultWriter write a .rslc container:
+
+	MAGIC | channel matrices, each float64 and aligned to ALIGN bytes | JSON header | header offset | MAGIC
+
+The header is the results dict batcher.batch() returns, with each output's channel matrix replaced
+by where it sits in the file. ResultFile maps the file and hands out matrices one at a time by
+track and permutation index, so looking at one run doesn't read the others. unpack() still reads
+the pickled .rslp files packed before.
+
+A ResultWriter fills the file in as a batch runs. Each output is appended as it comes in, and every
+so often a header covering everything so far is appended after it. The last complete header is the
+one that counts, so a batch that dies part way leaves a file holding what it got through.
+study_writer() can pick such a file back up: a study with the same key (batcher.study_key) keeps the
+results already in it and only runs the permutations that are missing.
+"""
+
+MAGIC = b'RSLC\x00\x00\x00\x01'
+ALIGN = 64
+TRAILER = struct.Struct('<Q8s')
+
+# How often a ResultWriter writes out the header while a batch runs
+FLUSH_SECONDS = 10.0
+
 def pack(results, filename):
+	writer = ResultWriter(result_path(filename))
+	writer.begin(results)
+	for track_no, track in enumerate(results["track_data"]):
+		writer.begin_track(track, len(track["times"]))
+		for i in range(len(track["times"])):
+			result = (track["times"][i], track["co2s"][i])
+			if len(track["outputs"]) > 0:
+				result += (track["outputs"][i],)
+			writer.add(track_no, i, result)
+	writer.close(results)
+
+	return writer.filename
+
+def unpack(filename):
+	# return shelve.open(filename, writeback=False)["data"]
+	if is_container(filename):
+		return ResultFile(filename).unpack()
+	with open(filename, 'rb') as f:
+		return pickle.load(f)
+
+def toRslpFilename(filename):
+	return filename + '-' + str(time.time()).split(".")[0]
+
+def result_path(filename):
+	# a fresh out/ directory and file for a study's results
 	base = os.path.dirname(__file__)
 	filename = toRslpFilename(filename)
 	os.makedirs(os.path.dirname(base + "/out/" + filename + "/"))
-	filename = base + "/out/" + filename + "/" + filename + ".rslp"
 
 	# r = shelve.open(filename, writeback=False)
 	# r["data"] = results
 	# r.close()
 
-	with open(filename, 'wb') as f:
-		pickle.dump(results, f, protocol=2)
+	return base + "/out/" + filename + "/" + filename + ".rslc"
 
-	return filename
+def find_partial(filename, study):
+	# the newest result file of the study keyed study that its writer didn't get to close, or None
+	base = os.path.dirname(__file__) + "/out/"
+	if not os.path.isdir(base):
+		return None
 
-def unpack(filename):
-	# return shelve.open(filename, writeback=False)["data"]
+	found = []
+	for d in os.listdir(base):
+		fn = base + d + "/" + d + ".rslc"
+		if d[:len(filename)+1] != filename + '-' or not os.path.isfile(fn):
+			continue
+		try:
+			f = ResultFile(fn)
+		except ValueError:
+			continue
+		if not f.complete and f.header.get("study") == study:
+			found.append((os.path.getmtime(fn), fn))
+		f.close()
+
+	return max(found)[1] if len(found) > 0 else None
+
+def study_writer(filename, study, resume=False):
+	"""
+	A ResultWriter for the study keyed study, writing to a fresh file under out/ named after filename.
+	With resume, an unfinished file of the same study is picked up instead where there is one.
+	"""
+	partial = find_partial(filename, study) if resume else None
+	if partial is not None:
+		return ResultWriter.resume(partial)
+	return ResultWriter(result_path(filename), study=study)
+
+def is_container(filename):
 	with open(filename, 'rb') as f:
-		return pickle.load(f)
+		return f.read(len(MAGIC)) == MAGIC
 
-def toRslpFilename(filename):
-	return filename + '-' + str(time.time()).split(".")[0]
\ No newline at end of file
+def write_output(f, index, data):
+	# append one output's channel matrix at the next aligned offset; returns its header entry
+	data = np.ascontiguousarray(data, dtype='<f8')
+	offset = f.tell()
+	if offset % ALIGN:
+		f.write(b'\0' * (ALIGN - offset % ALIGN))
+		offset = f.tell()
+	f.write(data.tobytes())
+	return {"index": list(index), "offset": offset, "shape": list(data.shape), "dtype": data.dtype.str}
+
+def write_header(f, header):
+	offset = f.tell()
+	f.write(json.dumps(header, default=to_json).encode('utf-8'))
+	f.write(TRAILER.pack(offset, MAGIC))
+
+def read_header(data):
+	# the last complete header in a mapped container and where it ends; a torn write after it is ignored
+	end = len(data)
+	while True:
+		pos = data.rfind(MAGIC, TRAILER.size, end)
+		if pos < 0:
+			raise ValueError("no complete header")
+		offset = struct.unpack('<Q', data[pos-8:pos])[0]
+		if len(MAGIC) <= offset <= pos-8:
+			try:
+				return (json.loads(data[offset:pos-8].decode('utf-8')), pos + len(MAGIC))
+			except ValueError:
+				pass
+		end = pos + len(MAGIC) - 1
+
+def header_fields(results):
+	# the batch-wide fields of a results dict
+	return dict((k, v) for k, v in results.items() if k != "track_data")
+
+def to_json(value):
+	# what json can't take as it is
+	if isinstance(value, np.generic):
+		return value.item()
+	if isinstance(value, np.ndarray):
+		return value.tolist()
+	raise TypeError("%s can't go in a result header" % type(value).__name__)
+
+class ResultWriter(object):
+	"""
+	Writes a .rslc container as a batch runs. begin() and close() take the batch-wide fields of the
+	results dict, begin_track() a track's, and add() each permutation's result as it comes in.
+	"""
+	def __init__(self, filename, flush_seconds=FLUSH_SECONDS, study=None):
+		self.filename = filename
+		self.flush_seconds = flush_seconds
+		self.header = {"track_data": [], "study": study, "complete": False}
+		self.outputs = [] # per track, {position: output entry}
+		self.tracks = 0
+		self.f = open(filename, 'wb')
+		self.f.write(MAGIC)
+		self.flushed = time.time()
+
+	@classmethod
+	def resume(cls, filename, flush_seconds=FLUSH_SECONDS):
+		"""
+		A writer carrying on with a file an earlier writer didn't close. Whatever was written after its
+		last header is dropped; result() hands back what that header holds.
+		"""
+		f = ResultFile(filename)
+		header, end = f.header, f.end
+		f.close()
+
+		writer = cls.__new__(cls)
+		writer.filename = filename
+		writer.flush_seconds = flush_seconds
+		writer.header = header
+		writer.header["complete"] = False
+		# outputs are written for every result or none, so a track's entries line up with its filled in times
+		writer.outputs = []
+		for track in header["track_data"]:
+			done = [i for i, t in enumerate(track["times"]) if t is not None]
+			writer.outputs.append(dict(zip(done, track["outputs"])))
+		writer.tracks = 0
+		writer.f = open(filename, 'r+b')
+		writer.f.truncate(end)
+		writer.f.seek(end)
+		writer.flushed = time.time()
+		return writer
+
+	def begin(self, results):
+		self.header.update(header_fields(results))
+
+	def begin_track(self, track_data, n):
+		# a track of n permutations; results fill in its times and co2s by position
+		track = dict((k, v) for k, v in track_data.items() if k not in ("times", "co2s", "outputs"))
+		track_no = self.tracks
+		self.tracks += 1
+		if track_no < len(self.header["track_data"]):
+			# resuming; keep what the earlier writer got through
+			done = self.header["track_data"][track_no]
+			track["times"] = done["times"]
+			track["co2s"] = done["co2s"]
+			track["outputs"] = done["outputs"]
+			self.header["track_data"][track_no] = track
+			return
+
+		track["times"] = [None for i in range(n)]
+		track["co2s"] = [None for i in range(n)]
+		track["outputs"] = []
+		self.header["track_data"].append(track)
+		self.outputs.append({})
+
+	def result(self, track_no, i):
+		# the result already in the file for the permutation at position i of the track, as add() returned it, or None
+		track = self.header["track_data"][track_no]
+		if track["times"][i] is None:
+			return None
+		result = (tuple(track["times"][i]), track["co2s"][i])
+		if i in self.outputs[track_no]:
+			entry = self.outputs[track_no][i]
+			result += (tuple(entry["index"]) + (OutputHandle(self.filename, entry),),)
+		return result
+
+	def add(self, track_no, i, result):
+		"""
+		Records a permutation_result for the permutation at position i of the track. An output is
+		written to the file straight away; the result comes back with an OutputHandle in its place.
+		"""
+		track = self.header["track_data"][track_no]
+		track["times"][i] = result[0]
+		track["co2s"][i] = result[1]
+		if len(result) > 2:
+			output = result[2]
+			entry = write_output(self.f, output[:-1], output[-1])
+			self.outputs[track_no][i] = entry
+			self.f.flush()
+			result = result[:2] + (tuple(output[:-1]) + (OutputHandle(self.filename, entry),),)
+
+		if time.time() - self.flushed >= self.flush_seconds:
+			self.flush()
+		return result
+
+	def flush(self):
+		for track, outputs in zip(self.header["track_data"], self.outputs):
+			track["outputs"] = [outputs[i] for i in sorted(outputs)]
+		write_header(self.f, self.header)
+		self.f.flush()
+		self.flushed = time.time()
+
+	def close(self, results=None):
+		# results brings any batch-wide fields filled in since begin()
+		if results is not None:
+			self.header.update(header_fields(results))
+		self.header["complete"] = True
+		self.flush()
+		self.f.close()
+
+class OutputHandle(object):
+	"""
+	Where one output's channel matrix sits in a result file. numpy maps it from there when it's
+	asked for an array (np.array(handle), np.asarray(handle)).
+	"""
+	def __init__(self, filename, entry):
+		self.filename = filename
+		self.entry = entry
+
+	def load(self):
+		shape = tuple(self.entry["shape"])
+		if np.prod(shape) == 0:
+			return np.zeros(shape, dtype=self.entry["dtype"])
+		return np.memmap(self.filename, dtype=self.entry["dtype"], mode='r', offset=self.entry["offset"], shape=shape)
+
+	def __array__(self, dtype=None, copy=None):
+		return np.asarray(self.load(), dtype=dtype)
+
+class ResultFile(object):
+	"""
+	A .rslc container, mapped rather than read. header is the results dict with output entries in
+	place of the channel matrices; output(track, index) maps one of them. complete is False for a
+	file a ResultWriter didn't get to close, whose header covers what was written up to its last flush.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		with open(filename, 'rb') as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.data[:len(MAGIC)] != MAGIC:
+			self.data.close()
+			raise ValueError("%s is not a result container" % filename)
+		try:
+			self.header, self.end = read_header(self.data)
+		except ValueError:
+			self.data.close()
+			raise ValueError("%s has no complete header" % filename)
+		self.complete = self.header.pop("complete", True)
+		self.entries = [dict((tuple(e["index"]), e) for e in track["outputs"]) for track in self.header["track_data"]]
+
+	def close(self):
+		# outputs handed out by output() and unpack() can't be used after this
+		self.data.close()
+
+	def tracks(self):
+		return [track["name"] for track in self.header["track_data"]]
+
+	def track_no(self, track):
+		# a track by position or by name
+		if isinstance(track, str):
+			return self.tracks().index(track)
+		return track
+
+	def indices(self, track):
+		return [tuple(e["index"]) for e in self.header["track_data"][self.track_no(track)]["outputs"]]
+
+	def output(self, track, index):
+		# the channel matrix of the permutation at index (a tuple, one position per axis) on track
+		e = self.entries[self.track_no(track)][tuple(index)]
+		count = int(np.prod(e["shape"]))
+		return np.frombuffer(self.data, dtype=e["dtype"], count=count, offset=e["offset"]).reshape(e["shape"])
+
+	def unpack(self):
+		# the results dict as batcher.batch() gave it, with mapped channel matrices for outputs
+		results = dict(self.header)
+		results["track_data"] = []
+		for track_no, track in enumerate(self.header["track_data"]):
+			track = dict(track)
+			track["outputs"] = [tuple(e["index"]) + (self.output(track_no, e["index"]),) for e in track["outputs"]]
+			results["track_data"].append(track)
+		return results
@@ -0,0 +1,197 @@
+"""
+On-disk cache of solver outputs, addressed by an MD5 of everything that determines a run:
+the prepped vehicle, the track file contents and segmentation options, the model (and the
+source of every module a solve runs, see solver_sources), dl and steady_state. Overlapping studies reuse the
+permutations they share instead of re-running them.
+
+Lookups and eviction happen in the batching process; workers write their own entries with
+store() so outputs never have to travel back through the pool just to be cached.
+"""
+
+import numpy as np
+import hashlib
+import inspect
+import logging
+import os
+
+# Bump to drop every existing entry when the entry format changes
+CACHE_VERSION = 1
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DIR = ROOT + "/cache/runs"
+# the persistent tier of track_segmentation's segment cache lives alongside
+SEGMENT_DIR = os.path.dirname(os.path.abspath(__file__)) + "/cache/segments"
+DEFAULT_MAX_BYTES = 2 ** 30
+
+class RunCache(object):
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.logged = (0, 0) # hits and misses when log_track last ran
+        self.study_start = (0, 0) # and when log_stats did
+        self.code_digests = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, vehicle, track_hash, dl, opts, model, steady_state):
+        h = hashlib.md5()
+        feed(h, CACHE_VERSION)
+        feed(h, model.name)
+        feed(h, self.code_digest(model, vehicle))
+        feed(h, vehicle.parameters())
+        feed(h, track_hash)
+        feed(h, dl)
+        feed(h, opts)
+        feed(h, bool(steady_state))
+        return h.hexdigest()
+
+    def code_digest(self, model, vehicle):
+        # a change to the model, the vehicle physics or anything else a solve runs must not serve stale results
+        sources = code_sources(model, vehicle)
+        if sources not in self.code_digests:
+            self.code_digests[sources] = digest_files(sources)
+        return self.code_digests[sources]
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        fn = self.path(key)
+        try:
+            data = np.load(fn)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # mtime doubles as the last-used time for eviction
+        try:
+            os.utime(fn, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def trim(self):
+        entries = []
+        for fn in os.listdir(self.directory):
+            if fn[-4:] != ".npy":
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+
+        entries.sort()
+        total = sum([e[1] for e in entries])
+        count = len(entries)
+        evicted = 0
+        for mtime, size, fn in entries:
+            if total <= self.max_bytes and (self.max_entries is None or count <= self.max_entries):
+                break
+            try:
+                os.remove(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            total -= size
+            count -= 1
+            evicted += 1
+
+        return (count, total, evicted)
+
+    def log_track(self, name):
+        # the lookups since the last track
+        hits, misses = self.hits - self.logged[0], self.misses - self.logged[1]
+        self.logged = (self.hits, self.misses)
+        lookups = hits + misses
+        rate = 100.0 * hits / lookups if lookups > 0 else 0.0
+        logging.info("Run cache on %s: %d hits, %d misses (%.1f%% hit rate)" % (name, hits, misses, rate))
+
+    def log_stats(self):
+        # once a study is done: trims the cache, then logs the study's totals
+        count, total, evicted = self.trim()
+        hits, misses = self.hits - self.study_start[0], self.misses - self.study_start[1]
+        self.study_start = self.logged = (self.hits, self.misses)
+        lookups = hits + misses
+        rate = 100.0 * hits / lookups if lookups > 0 else 0.0
+        logging.info("Run cache: %d hits, %d misses (%.1f%% hit rate); %d entries, %.1f MB, %d evicted" %
+            (hits, misses, rate, count, total / 1e6, evicted))
+
+def store(fn, data):
+    # write then rename, so a concurrent reader never sees half an entry
+    tmp = "%s.%d.tmp" % (fn, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, fn)
+    except (IOError, OSError):
+        logging.exception("Could not write run cache entry %s" % fn)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def solver_sources():
+    # the sims package, the vehicle and the track segmentation: everything a solve's output depends on
+    sims = os.path.join(ROOT, "sims")
+    return [os.path.join(sims, fn) for fn in os.listdir(sims) if fn[-3:] == ".py"] + [
+        os.path.join(ROOT, "input_processing", "vehicle.py"),
+        os.path.join(ROOT, "input_processing", "track_segmentation.py")]
+
+def code_sources(model, vehicle):
+    # solver_sources and the files the model and vehicle classes come from, as a sorted tuple
+    sources = set(solver_sources())
+    for fn in (source_file(model.model), source_file(vehicle)):
+        if fn is not None:
+            sources.add(os.path.abspath(fn))
+    return tuple(sorted(sources))
+
+def digest_files(sources):
+    h = hashlib.md5()
+    for fn in sources:
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def source_file(obj):
+    try:
+        return inspect.getsourcefile(type(obj))
+    except TypeError:
+        return None
+
+def feed(h, obj):
+    """
+    Feeds a canonical encoding of obj into hash h. Dicts are fed in key order and arrays by
+    their raw bytes, so equal configurations always hash the same.
+    """
+    if isinstance(obj, dict):
+        h.update(b'{')
+        for k in sorted(obj.keys(), key=str):
+            feed(h, k)
+            feed(h, obj[k])
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for o in obj:
+            feed(h, o)
+        h.update(b']')
+    elif isinstance(obj, np.ndarray):
+        h.update(('a%s%s' % (obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (float, np.floating)):
+        h.update(('f' + repr(float(obj))).encode())
+    elif isinstance(obj, (bool, np.bool_)):
+        h.update(('b%d' % bool(obj)).encode())
+    elif isinstance(obj, (int, np.integer)):
+        h.update(('i%d' % int(obj)).encode())
+    elif isinstance(obj, str):
+        h.update(('s%d:' % len(obj)).encode() + obj.encode('utf-8'))
+    elif obj is None:
+        h.update(b'n')
+    elif hasattr(obj, '__dict__'):
+        h.update(('o' + type(obj).__name__).encode())
+        feed(h, obj.__dict__)
+    else:
+        h.update(('r' + repr(obj)).encode())
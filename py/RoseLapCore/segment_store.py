@@ -0,0 +1,64 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import collections
+import input_processing.track_segmentation as track_segmentation
+
+"""
+Read-only track segment storage shared with batch worker processes.
+The batcher writes each track's columns once, a .npy file per column in the column's own dtype;
+permutations only carry a small SegmentHandle, and workers memory-map the files the first time they
+see that track and keep its views (TrackArrays.views) for every permutation on it after. IPC per
+permutation then no longer grows with track length.
+"""
+
+SegmentHandle = collections.namedtuple('SegmentHandle', ['key', 'path', 'kind'])
+
+# The TrackArrays columns written for each track, as <path>.<field>.npy
+FIELDS = ('length', 'curvature', 'sector', 'x', 'y')
+
+# How many tracks a worker keeps attached at once
+MAX_ATTACHED = 4
+
+_attached = collections.OrderedDict()
+
+class SegmentStore(object):
+    def __init__(self, directory=None):
+        self.owned = directory is None
+        self.directory = tempfile.mkdtemp(prefix='roselap-segments-') if directory is None else directory
+        self.handles = {}
+
+    def put(self, key, segments):
+        if key not in self.handles:
+            path = os.path.join(self.directory, key)
+            for field in FIELDS:
+                np.save(path + '.' + field + '.npy', getattr(segments, field))
+            self.handles[key] = SegmentHandle(key, path, segments.kind)
+
+        return self.handles[key]
+
+    def close(self):
+        self.handles = {}
+        if self.owned:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+def attach(handle):
+    if handle.path in _attached:
+        _attached.move_to_end(handle.path)
+        return _attached[handle.path]
+
+    columns = dict((field, np.load(handle.path + '.' + field + '.npy', mmap_mode='r')) for field in FIELDS)
+    segments = track_segmentation.TrackArrays(kind=handle.kind, **columns).views()
+
+    _attached[handle.path] = segments
+    while len(_attached) > MAX_ATTACHED:
+        _attached.popitem(last=False)
+
+    return segments
+
+def resolve(segments):
+    # permutations carry either the track's views themselves (serial runs) or a handle into a store
+    if isinstance(segments, SegmentHandle):
+        return attach(segments)
+    return segments
@@ -0,0 +1,83 @@
+import numpy as np
+import math
+from constants import *
+
+"""
+Braking point search support for the transient solvers (sim_onetire, sim_twotires, sim_fourtires).
+
+By default the solvers back up from a crash and bisect over where to start braking, re-running the
+braking from each probe, and roll the output matrix back to how it was at the crash before every
+probe. RollbackWindow keeps just the rows a probe can overwrite, rather than a copy of the whole
+matrix.
+
+With brake_search='envelope', sim_onetire takes envelope_start instead: one sweep back from the
+crash, in closed form for its point mass, of the fastest the car can go and still brake down to the
+corner. Braking starts where that envelope meets the trace so far and runs once; the solver only
+backs up further, a segment at a time, if that braking crashes. The two and four tire models stay
+with bisection, as a point mass brakes harder than they do once load transfers.
+"""
+
+BRAKE_SEARCHES = ('bisect', 'envelope')
+
+def corner_limit(vehicle, curvature):
+  # the fastest a point mass takes curvature (derated) on its tires' lateral grip with full aero;
+  # inf where downforce adds grip faster than the corner asks for it
+  need = vehicle.mass*curvature - vehicle.comb_tire_mu_y*vehicle.aero().downforce[AERO_FULL]
+  if need <= 0:
+    return np.inf
+  return math.sqrt((vehicle.comb_tire_mu_y*vehicle.mass*vehicle.g + 4*vehicle.comb_tire_offset_y)/need)
+
+def braking_decel(vehicle, curvature, v):
+  # how hard a point mass brakes at v on curvature (derated) with full aero
+  f_lat = vehicle.mass*v**2*curvature
+  f_remaining = vehicle.f_long_remain(4, vehicle.mass*vehicle.g + vehicle.downforce(v, AERO_FULL), f_lat)[0]
+  return (max(f_remaining, 0) + vehicle.drag(v, AERO_FULL))/vehicle.mass
+
+def envelope_start(vehicle, output, segments, crash):
+  """
+  The segment to start braking into for a crash stepping into segment crash. The envelope runs
+  back from the crash: the car can go into segment j no faster than it takes j's corner, nor faster
+  than it brakes down through j to the envelope at the end of j. Braking deceleration is taken at
+  the slower, far end of each segment, which keeps the sweep explicit. Braking starts after the
+  last row of the trace that the envelope doesn't cut below.
+  """
+  def curvature(segment):
+    return segment.curvature/(1.0 + vehicle.r_add*segment.curvature)
+
+  # the fastest the row before segment j may be, starting with the step that crashed
+  j = crash
+  v = corner_limit(vehicle, curvature(segments[j]))
+  while j > 1 and output[j-1,O_VELOCITY] > v:
+    segment = segments[j-1]
+    k = curvature(segment)
+    if v < np.inf:
+      v = min(corner_limit(vehicle, k), math.sqrt(v**2 + 2*braking_decel(vehicle, k, v)*segment.length))
+    else:
+      v = corner_limit(vehicle, k)
+    j -= 1
+  return j
+
+class RollbackWindow(object):
+  """
+  The rows of a solver's output matrix from the earliest braking probe up to the crash at precrash_i,
+  as they were when the step into precrash_i failed. Probes only write rows from where they start
+  braking up to the crash, so putting the window back restores the matrix. As the search backs up
+  the window grows to cover the earlier rows, which nothing has written to since the crash.
+  """
+  def __init__(self, output, start, precrash_i):
+    self.end = min(precrash_i+1, len(output))
+    self.start = self.end
+    self.rows = output[self.end:self.end].copy()
+    self.cover(output, start)
+
+  def cover(self, output, start):
+    start = max(start, 0)
+    if start < self.start:
+      self.rows = np.concatenate((output[start:self.start], self.rows))
+      self.start = start
+
+  def restore(self, output, start):
+    # put the rows back in place before a probe that starts braking at start
+    self.cover(output, start)
+    output[self.start:self.end] = self.rows
+    return output
@@ -0,0 +1,90 @@
+import numpy as np
+from constants import *
+
+"""
+Array versions of the steady_corner arithmetic, so the sim_ss_* models can bisect every corner of a
+track at once. Each function follows its scalar counterpart operation for operation; a corner solved
+here matches the one steady_corner would give, down to the last bit.
+"""
+
+def square(x):
+  # elementwise x**2 as Python rounds it (libm pow); numpy's ** and power square by multiplying, which
+  # differs now and then, but float_power goes through pow
+  return np.float_power(np.asarray(x, dtype=np.float64), 2.0)
+
+def py_min(a, b):
+  # min(a, b) with Python's NaN handling: a unless b is strictly smaller
+  return np.where(b < a, b, a)
+
+def py_max(a, b):
+  # max(a, b) likewise: a unless b is strictly larger
+  return np.where(b > a, b, a)
+
+def downforce(vehicle, v2, aero_mode):
+  # Vehicle.downforce with v**2 already taken
+  return vehicle.aero().downforce[aero_mode] * v2
+
+def drag(vehicle, v2, aero_mode):
+  return vehicle.aero().drag[aero_mode] * v2
+
+def bisect_corners(vmax, n, evaluate, low, high):
+  """
+  The steady_corner bisection for n corners at once. evaluate(idx, v) gives the grip margin of the
+  corners idx at speeds v, along with a tuple of arrays to keep from the last evaluation of each corner.
+  A corner is done once its margin lands in [low, high); it speeds up while the margin is above 1e-3.
+  Returns (v, kept), where kept holds full length arrays in the order evaluate returned them.
+  """
+  v_lower = np.zeros(n)
+  v_upper = np.full(n, vmax, dtype=np.float64)
+  v_cur = (v_lower + v_upper)/2.0
+  v_working = np.ones(n)
+  kept = None
+
+  active = np.arange(n)
+  i = 0
+  while len(active) > 0:
+    margin, values = evaluate(active, v_cur[active])
+    if kept is None:
+      kept = [np.zeros(n) for value in values]
+    for k, value in zip(kept, values):
+      k[active] = value
+
+    done = (margin < high) & (margin >= low)
+    up = active[(margin > 1e-3) & ~done]
+    down = active[~(margin > 1e-3) & ~done]
+    v_working[up] = v_cur[up]
+    v_lower[up] = v_cur[up]
+    v_upper[down] = v_cur[down]
+
+    active = active[~done]
+    v_cur[active] = (v_lower[active] + v_upper[active])/2.0
+
+    i += 1
+    if i > 100:
+      v_cur[active] = v_working[active]
+      break
+
+  return v_cur, kept
+
+def corner_columns(sectors):
+  curvature = np.array([sector.curvature for sector in sectors], dtype=np.float64)
+  length = np.array([sector.length for sector in sectors], dtype=np.float64)
+  index = np.array([sector.i for sector in sectors], dtype=np.float64)
+  return curvature, length, index
+
+def corner_channels(vehicle, curvature, length, index, v, a_lat, F_long):
+  # the columns every steady corner fills the same way; the model adds its forces
+  channels = np.zeros((len(v), O_MATRIX_COLS))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    channels[:,O_TIME] = np.where(v == 0, 1000, length/v)
+  channels[:,O_DISTANCE] = length
+  channels[:,O_VELOCITY] = v
+  channels[:,O_SECTORS] = index
+  channels[:,O_STATUS] = S_SUSTAINING
+  channels[:,O_GEAR] = np.nan
+  channels[:,O_LAT_ACC] = a_lat/vehicle.g
+  channels[:,O_CURVATURE] = curvature
+  channels[:,O_ENG_RPM] = np.nan
+  channels[:,O_CO2] = length*F_long*vehicle.co2_factor/vehicle.e_factor
+  channels[:,O_AERO_MODE] = AERO_FULL
+  return channels
@@ -0,0 +1,100 @@
+import numpy as np
+from collections import OrderedDict
+from constants import *
+
+"""
+Memo of steady_corner solutions. A steady corner depends only on the sector's curvature and length
+and on a handful of vehicle fields, so sectors sharing a radius (skidpads, repeated DXF arcs) and
+sweep permutations that leave those fields alone reuse one bisection. Each sim_ss_* model lists
+the fields its steady_corner reads, directly or through Vehicle methods, in corner_fields.
+"""
+
+# fields read by Vehicle.downforce/drag and by the tire grip methods
+AERO_FIELDS = ('downforce_35mph', 'drag_35mph')
+COMB_TIRE_FIELDS = ('comb_tire_mu_x', 'comb_tire_offset_x', 'comb_tire_mu_y', 'comb_tire_offset_y')
+AXLE_TIRE_FIELDS = ('front_tire_mu_x', 'front_tire_offset_x', 'front_tire_mu_y', 'front_tire_offset_y',
+  'rear_tire_mu_x', 'rear_tire_offset_x', 'rear_tire_mu_y', 'rear_tire_offset_y')
+
+# How many vehicle signatures to keep corners for
+MAX_SIGNATURES = 64
+
+class SteadyCornerCache(object):
+  def __init__(self, max_signatures=MAX_SIGNATURES):
+    self.max_signatures = max_signatures
+    self.corners = OrderedDict() # signature -> {(curvature, length): channels}
+    self.hits = 0
+    self.misses = 0
+
+  def signature(self, model, vehicle):
+    return (type(model).__name__,) + tuple([freeze(getattr(vehicle, f, None)) for f in model.corner_fields])
+
+  def corners_for(self, model, vehicle):
+    sig = self.signature(model, vehicle)
+    if sig in self.corners:
+      self.corners[sig] = self.corners.pop(sig)
+    else:
+      self.corners[sig] = {}
+      while len(self.corners) > self.max_signatures:
+        self.corners.popitem(last=False)
+    return self.corners[sig]
+
+  def steady_corner(self, model, vehicle, sector, solve):
+    corners = self.corners_for(model, vehicle)
+
+    key = (sector.curvature, sector.length)
+    if key in corners:
+      self.hits += 1
+      channels = corners[key].copy()
+      channels[O_SECTORS] = sector.i
+      return channels
+
+    self.misses += 1
+    channels = solve(vehicle, sector)
+    corners[key] = channels.copy()
+    return channels
+
+  def steady_corner_batch(self, model, vehicle, sectors, solve):
+    """
+    steady_corner for every sector of a track: channels for each curved sector, None for straights.
+    The corners missing from the cache go to solve(vehicle, sectors) in a single call.
+    """
+    corners = self.corners_for(model, vehicle)
+
+    missing = OrderedDict()
+    curved = 0
+    for sector in sectors:
+      if sector.curvature > 0:
+        curved += 1
+        key = (sector.curvature, sector.length)
+        if key not in corners and key not in missing:
+          missing[key] = sector
+
+    if len(missing) > 0:
+      for key, channels in zip(missing.keys(), solve(vehicle, list(missing.values()))):
+        corners[key] = channels
+    # a radius that repeats within the track is a hit after its first solve, as it would be one at a time
+    self.misses += len(missing)
+    self.hits += curved - len(missing)
+
+    conditions = [None for sector in sectors]
+    for i, sector in enumerate(sectors):
+      if sector.curvature > 0:
+        conditions[i] = corners[(sector.curvature, sector.length)].copy()
+        conditions[i][O_SECTORS] = sector.i
+    return conditions
+
+  def stats(self):
+    return (self.hits, self.misses)
+
+def freeze(value):
+  # a hashable stand-in for a vehicle field
+  if isinstance(value, (list, tuple)):
+    return tuple([freeze(v) for v in value])
+  if isinstance(value, np.ndarray):
+    return (value.dtype.str, value.shape, value.tobytes())
+  if isinstance(value, dict):
+    return tuple(sorted([(k, freeze(v)) for k, v in value.items()]))
+  return value
+
+# shared by every sim_ss_* model in this process
+steady_corners = SteadyCornerCache()
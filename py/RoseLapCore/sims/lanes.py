@@ -0,0 +1,149 @@
+import numpy as np
+from constants import *
+import corner_arrays
+
+"""
+Lockstep solving for batches of permutations. The permutations of a study run one model over the
+same sectors and dl, so every vehicle steps through the same rows in the same order; a solver can
+advance all of them at once, one numpy operation per step with a lane per vehicle.
+
+VehicleLanes stacks the fields those steps read into arrays with a lane per vehicle. Its methods
+follow their Vehicle counterparts operation for operation, so each lane comes out as its own
+vehicle's solve would, down to the last bit.
+"""
+
+# How many permutations the batcher hands a lockstep solver at once, and the fewest worth stepping
+# together; below that numpy's per-call overhead costs more than the lanes save
+LANE_WIDTH = 64
+MIN_LANES = 16
+
+def stackable(vehicles):
+  # whether the vehicles' engines and aero line up lane for lane
+  first = vehicles[0]
+  for vehicle in vehicles:
+    engine = vehicle.engine()
+    if engine.cvt != first.engine().cvt or len(engine.rpms) != len(first.engine().rpms) or len(engine.torque) != len(engine.rpms):
+      return False
+    if len(vehicle.gears) != len(first.gears) or len(vehicle.aero().drag) != len(first.aero().drag):
+      return False
+  return True
+
+class VehicleLanes(object):
+  """
+  The fields of a list of prepped vehicles (see stackable) that drive steps read, as arrays.
+  Where a scalar step would divide by zero the lanes get inf or nan as numpy gives them, so callers
+  run these under np.errstate.
+  """
+  def __init__(self, vehicles):
+    def lanes(name):
+      return np.array([getattr(vehicle, name) for vehicle in vehicles], dtype=np.float64)
+
+    for name in ['mass', 'g', 'r_add', 'shift_time', 'co2_factor', 'e_factor',
+      'comb_tire_mu_x', 'comb_tire_offset_x', 'comb_tire_mu_y', 'comb_tire_offset_y',
+      'rear_tire_radius', 'front_tire_radius', 'final_drive_reduction', 'engine_reduction', 'transmission_efficiency']:
+      setattr(self, name, lanes(name))
+
+    # aero coefficients as [mode][lane]
+    self.downforce_coefs = np.array([vehicle.aero().downforce for vehicle in vehicles], dtype=np.float64).T
+    self.drag_coefs = np.array([vehicle.aero().drag for vehicle in vehicles], dtype=np.float64).T
+    self.same_as_full = np.array([vehicle.aero().same_as_full for vehicle in vehicles], dtype=bool).T
+
+    engines = [vehicle.engine() for vehicle in vehicles]
+    self.cvt = engines[0].cvt
+    self.rpms = np.array([engine.rpms for engine in engines], dtype=np.float64)
+    self.torque = np.array([engine.torque for engine in engines], dtype=np.float64)
+    self.gears = np.array([vehicle.gears for vehicle in vehicles], dtype=np.float64)
+    self.n_gears = self.gears.shape[1]
+    self.rpm_limit = np.array([vehicle.engine_rpms[-1] for vehicle in vehicles], dtype=np.float64)
+    if self.cvt:
+      self.crank_rpm = np.array([engine.crank_rpm for engine in engines], dtype=np.float64)
+      self.eng_torque = np.array([engine.eng_torque for engine in engines], dtype=np.float64)
+    self.lane = np.arange(len(vehicles))
+
+    # the engine table laid out for engine_forces: each lane's rpms and torque run on from the last lane's,
+    # with the differences eng_force interpolates over taken at each rpm from the one below it
+    if not self.cvt:
+      n_rpms = self.rpms.shape[1]
+      self.row_start = (self.lane * n_rpms)[:, np.newaxis]
+      self.flat_rpms = self.rpms.ravel()
+      self.flat_torque = self.torque.ravel()
+      self.rpm_steps = np.concatenate((np.ones((len(vehicles), 1)), self.rpms[:, :-1] - self.rpms[:, 1:]), axis=1).ravel()
+      self.torque_steps = np.concatenate((np.zeros((len(vehicles), 1)), self.torque[:, :-1] - self.torque[:, 1:]), axis=1).ravel()
+      for name in ['engine_reduction', 'final_drive_reduction', 'rear_tire_radius', 'transmission_efficiency']:
+        setattr(self, 'col_' + name, getattr(self, name)[:, np.newaxis])
+      self.col_rpm_floor = self.rpms[:, :1]
+      self.col_rpm_limit = self.rpms[:, -1:]
+      self.low_force = self.torque[:, :1] * self.col_engine_reduction * self.gears * self.col_final_drive_reduction / self.front_tire_radius[:, np.newaxis] *self.col_transmission_efficiency
+
+  def downforce(self, v2, aero_mode):
+    # Vehicle.downforce with v**2 already taken; aero_mode is one mode or one per lane
+    return self.downforce_coefs[aero_mode, self.lane] * v2
+
+  def drag(self, v2, aero_mode):
+    return self.drag_coefs[aero_mode, self.lane] * v2
+
+  def aero_matters(self, v2, aero_mode):
+    # Vehicle.aero_matters with v**2 already taken, for one aero_mode per lane
+    downforce = np.abs(self.downforce_coefs[aero_mode, self.lane]*v2 - self.downforce_coefs[AERO_FULL, self.lane]*v2) < 1e-3
+    drag = np.abs(self.drag_coefs[aero_mode, self.lane]*v2 - self.drag_coefs[AERO_FULL, self.lane]*v2) < 1e-3
+    return ~self.same_as_full[aero_mode, self.lane] & ~(downforce & drag)
+
+  def f_long_remain(self, n_tires, f_norm, f_lat):
+    # first element of Vehicle.f_long_remain for the combined tires
+    f_x_max = self.comb_tire_mu_x*(f_norm/n_tires) + self.comb_tire_offset_x
+    f_y_max = self.comb_tire_mu_y*(f_norm/n_tires) + self.comb_tire_offset_y
+    f_long = np.sqrt(np.maximum(1-corner_arrays.square(np.abs(f_lat)/n_tires)/f_y_max/f_y_max, 0))*f_x_max
+    f_long = np.where(f_y_max < np.abs(f_lat/n_tires), -np.inf, f_long*n_tires)
+    return np.where(f_norm <= 0.0, 0.0, f_long)
+
+  def engine_forces(self, v):
+    """
+    Vehicle.eng_force at v in every gear, as (force, crank_rpm) arrays indexed [lane, gear]. A CVT
+    has the one column, which is what it gives in any gear.
+    """
+    if self.cvt:
+      cvt_ratio = np.where(v > 0, self.crank_rpm/(v / self.rear_tire_radius * 9.5493), np.inf)
+      return ((cvt_ratio*self.eng_torque*self.transmission_efficiency)[:, np.newaxis], self.crank_rpm[:, np.newaxis])
+
+    eng_output_rpm = v / self.rear_tire_radius * 9.5493 * self.final_drive_reduction
+    crank_rpm = (eng_output_rpm * self.engine_reduction)[:, np.newaxis] * self.gears
+    return (self.crank_forces(crank_rpm, self.gears, self.low_force), crank_rpm)
+
+  def engine_force(self, v, gear):
+    # engine_forces in just the one gear for each lane, gear being an integer array
+    if self.cvt:
+      forces, crank_rpms = self.engine_forces(v)
+      return (forces[:, 0], crank_rpms[:, 0])
+
+    gear_ratio = self.gears[self.lane, gear][:, np.newaxis]
+    eng_output_rpm = v / self.rear_tire_radius * 9.5493 * self.final_drive_reduction
+    crank_rpm = (eng_output_rpm * self.engine_reduction)[:, np.newaxis] * gear_ratio
+    low_force = self.low_force[self.lane, gear][:, np.newaxis]
+    return (self.crank_forces(crank_rpm, gear_ratio, low_force)[:, 0], crank_rpm[:, 0])
+
+  def crank_forces(self, crank_rpm, gear_ratio, low_force):
+    # the force at the tires for crank speeds indexed [lane, gear], gear_ratio and low_force (the force
+    # under the lowest rpm) likewise
+    # interpolate from the first rpm above the crank's, as bisect_right would find it
+    i = np.clip((self.rpms[:, np.newaxis, :] <= crank_rpm[:, :, np.newaxis]).sum(axis=-1), 1, self.rpms.shape[1]-1)
+    i += self.row_start
+    torque = self.flat_torque[i] + (crank_rpm - self.flat_rpms[i]) * self.torque_steps[i] / self.rpm_steps[i]
+
+    force = torque * self.col_engine_reduction * gear_ratio * self.col_final_drive_reduction / self.col_rear_tire_radius *self.col_transmission_efficiency
+    force = np.where(crank_rpm < self.col_rpm_limit, force, 0.0)
+    return np.where(crank_rpm <= self.col_rpm_floor, low_force, force)
+
+  def best_gear(self, forces):
+    # Vehicle.best_gear for each lane, from engine_forces
+    if self.cvt:
+      return np.zeros(len(self.lane), dtype=int)
+    opts = np.where(np.isnan(forces), -np.inf, forces)
+    best = opts.max(axis=-1)
+    besti = self.n_gears - 1 - np.argmax((opts == best[:, np.newaxis])[:, ::-1], axis=-1)
+    return np.where(best >= 0, besti, -1)
+
+  def in_gear(self, x, gear):
+    # each lane's entry of an engine_forces array for gear, an integer array
+    if self.cvt:
+      return x[:, 0]
+    return x[self.lane, gear]
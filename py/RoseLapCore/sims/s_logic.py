@@ -6,6 +6,13 @@ from sim_dp_nd_template import *
 from sim_ss_twotires import *
 from sim_ss_fourtires import *
 
+def points(segments):
+	# the models index single points over and over, so a TrackArrays passed in directly has its views
+	# built once for the solve rather than one per lookup; the batcher passes views it built per track
+	if hasattr(segments, 'views'):
+		return segments.views()
+	return segments
+
 class Simulation:
 	def __init__(self, model_type="one_tire"):
 		self.name = model_type
@@ -16,8 +23,12 @@ class Simulation:
 			self.model = sim_twotires()
 		elif model_type == "four_tires":
 			self.model = sim_fourtires()
+		elif model_type == "one_tire_envelope":
+			self.model = sim_onetire(brake_search='envelope')
 		elif model_type == "ss_one_tire":
 			self.model = sim_ss_onetire()
+		elif model_type == "ss_one_tire_analytic":
+			self.model = sim_ss_onetire(analytic=True)
 		elif model_type == "ss_two_tires":
 			self.model = sim_ss_twotires()
 		elif model_type == "ss_four_tires":
@@ -28,31 +39,43 @@ class Simulation:
 			raise ValueError("Please provide a valid simulation model.")
 
 	def copy(self):
-		if self.name == "one_tire":
-			return sim_onetire()
-		elif self.name == "two_tires":
-			return sim_twotires()
-		elif self.name == "four_tires":
-			return sim_fourtires()
-		elif self.name == "ss_one_tire":
-			return sim_ss_onetire()
-		elif self.name == "ss_two_tires":
-			return sim_ss_twotires()
-		elif self.name == "ss_four_tires":
-			return sim_ss_fourtires()
-		elif self.name == "dp_nd":
-			return sim_dp_nd_template()
-		# else:
-		# 	raise ValueError("Please provide a valid simulation model.")
+		# A fresh wrapper (rather than the bare model) so solve/steady_solve keep passing dl only
+		# to the models that take it. It is also cheap to pickle for the batcher's worker pool.
+		return Simulation(self.name)
 
 	def solve(self, vehicle, segments, dl=0.3):
+		segments = points(segments)
 		if self.name[:3] == 'ss_':
 			return self.model.solve(vehicle, segments, dl=dl)
 		else:
 			return self.model.solve(vehicle, segments)
 
 	def steady_solve(self, vehicle, segments, dl=0.3):
+		segments = points(segments)
 		if self.name[:3] == 'ss_':
 			return self.model.steady_solve(vehicle, segments, dl=dl)
 		else:
-			return self.model.steady_solve(vehicle, segments)
\ No newline at end of file
+			return self.model.steady_solve(vehicle, segments)
+
+	def lockstep(self):
+		# whether the model solves several vehicles at once (see lanes.py); one_tire and ss_one_tire do so far
+		return hasattr(self.model, 'solve_lanes')
+
+	def solve_lanes(self, vehicles, segments, dl=0.3):
+		# solve for each of vehicles, in lockstep where the model can
+		segments = points(segments)
+		if not self.lockstep():
+			return [self.solve(vehicle, segments, dl=dl) for vehicle in vehicles]
+		if self.name[:3] == 'ss_':
+			return self.model.solve_lanes(vehicles, segments, dl=dl)
+		else:
+			return self.model.solve_lanes(vehicles, segments)
+
+	def steady_solve_lanes(self, vehicles, segments, dl=0.3):
+		segments = points(segments)
+		if not self.lockstep():
+			return [self.steady_solve(vehicle, segments, dl=dl) for vehicle in vehicles]
+		if self.name[:3] == 'ss_':
+			return self.model.steady_solve_lanes(vehicles, segments, dl=dl)
+		else:
+			return self.model.steady_solve_lanes(vehicles, segments)
\ No newline at end of file
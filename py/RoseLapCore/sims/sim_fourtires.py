@@ -2,6 +2,7 @@ import numpy as np
 import math
 
 from constants import *
+import braking
 
 """
 Two tire model
@@ -30,7 +31,7 @@ class sim_fourtires:
     """
     # return self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
     if brake:
-      if abs(vehicle.downforce(prior_result[O_VELOCITY],AERO_BRK)-vehicle.downforce(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3 and abs(vehicle.drag(prior_result[O_VELOCITY],AERO_BRK)-vehicle.drag(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3: 
+      if not vehicle.aero_matters(prior_result[O_VELOCITY],AERO_BRK):
           return self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
       out_brk = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_BRK)
       out_nor = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
@@ -47,7 +48,7 @@ class sim_fourtires:
       else:
         return None
     else:
-      if abs(vehicle.downforce(prior_result[O_VELOCITY],AERO_DRS)-vehicle.downforce(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3 and abs(vehicle.drag(prior_result[O_VELOCITY],AERO_DRS)-vehicle.drag(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3: 
+      if not vehicle.aero_matters(prior_result[O_VELOCITY],AERO_DRS):
           return self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
       out_drs = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_DRS)
       out_nor = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
@@ -438,7 +439,6 @@ class sim_fourtires:
 
     # set up initial stuctures
     output = np.zeros((len(segments), O_MATRIX_COLS))
-    precrash_output = np.zeros((len(segments), O_MATRIX_COLS))
     shifting = NOT_SHIFTING
     STALLED_SPEED = 2
     launched = False
@@ -495,8 +495,6 @@ class sim_fourtires:
           # print("%d,%.2f: start braking" % (i,output[i-1,O_DISTANCE]))
           # Start braking
 
-          # Make a backup (deep) copy of the output matrix prior to crash. (enables bisection algorithm)
-          precrash_output = np.copy(output)
           brake = True
           bounds_found = False
           failpt = i-1
@@ -506,6 +504,8 @@ class sim_fourtires:
           upper_brake_bound = i
           lower_brake_bound = i
           i = lower_brake_bound
+          # back up (enables bisection algorithm) only the rows braking from here on can overwrite
+          rollback = braking.RollbackWindow(output, i, precrash_i)
         elif bounds_found:
           # print("%d,%.2f: too short (%d, %d, %d)" % (i,output[i-1,O_DISTANCE],lower_brake_bound,middle_brake_bound,upper_brake_bound))
           # If the bounds for braking have been found, then clearly we're on the 'too short' side of the bisection algorithm. Scoot away.
@@ -522,7 +522,7 @@ class sim_fourtires:
             # # print ('no bam; %d' % middle_brake_bound)
             middle_brake_bound = middle_brake_bound_prop
             i = middle_brake_bound
-          output = np.copy(precrash_output)
+          output = rollback.restore(output, i)
         else:
           # print("%d,%.2f: move back" % (i,output[i-1,O_DISTANCE]))
           # If we haven't found bounds yet, need to keep moving backwards til a survivable point is reached.
@@ -531,7 +531,7 @@ class sim_fourtires:
           if lower_brake_bound < 0:
             lower_brake_bound = 0
           i = lower_brake_bound
-          output = np.copy(precrash_output)
+          output = rollback.restore(output, i)
           # print("to %d,%.2f" % (i,output[i,O_DISTANCE]))
         # reset shifting params when braking
         gear = None
@@ -553,14 +553,14 @@ class sim_fourtires:
         #upper_brake_bound = precrash_i-1 #lower_brake_bound+backup_amount
         middle_brake_bound = int(float(upper_brake_bound+lower_brake_bound)/2)
         i = middle_brake_bound
-        output = np.copy(precrash_output)
+        output = rollback.restore(output, i)
       elif failpt>=0 and bounds_found and abs(lower_brake_bound - upper_brake_bound) > 1:
         # print("%d,%.2f: converged (%d,%d,%d)" % (i,output[i,O_DISTANCE],lower_brake_bound,middle_brake_bound,upper_brake_bound))
         # If past the point of crashing and we've not yet successfully bisected to convergence
         lower_brake_bound = middle_brake_bound
         middle_brake_bound = int(float(upper_brake_bound+lower_brake_bound)/2)
         i = middle_brake_bound
-        output = np.copy(precrash_output)
+        output = rollback.restore(output, i)
       else:
         # print("%d,%.2f: normal op" % (i,output[i-1,O_DISTANCE]))
         # normal operation
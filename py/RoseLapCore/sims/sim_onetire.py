@@ -2,6 +2,9 @@ import numpy as np
 import math
 
 from constants import *
+import braking
+import corner_arrays
+import lanes
 import logging
 
 """
@@ -20,9 +23,167 @@ def floor_sqrt(x):
     return math.sqrt(x)
   return 0
 
+def floor_sqrt_lanes(x):
+  # floor_sqrt for an array, under np.errstate
+  return np.where(x > 0, np.sqrt(x), 0.0)
+
+class Lap(object):
+  """
+  solve()'s place in a lap: the output so far, the segment it steps into next (i), how it steps
+  (brake, shifting, gear), and the braking point search it runs when a step fails. The solver takes
+  each step and hands the result to advance(), which decides where to step next.
+  """
+  def __init__(self, vehicle, segments, output_0=None, output=None, brake_search='bisect'):
+    # output is the matrix to fill in, a fresh one unless it's given; brake_search is as for sim_onetire
+    self.vehicle = vehicle
+    self.segments = segments
+    self.envelope = (brake_search == 'envelope')
+    # set up initial stuctures
+    self.output = np.zeros((len(segments), O_MATRIX_COLS)) if output is None else output
+
+    if output_0 is None:
+      self.output[0,O_NF] = vehicle.mass*vehicle.g
+      self.gear = vehicle.best_gear(self.output[0,O_VELOCITY], np.inf)
+    else:
+      self.output[0,:] = output_0
+      self.output[0,O_TIME] = 0
+      self.output[0,O_DISTANCE] = 0
+      self.gear = vehicle.best_gear(output_0[O_VELOCITY], output_0[O_FR_REMAINING])
+
+    self.brake = False
+    self.shiftpt = -1
+    self.shift_v_req = 0
+
+    # step loop set up
+    self.i = 1
+    self.backup_amount = int(7.0/segments[0].length)
+    self.bounds_found = False
+    self.failpt = -1
+    self.precrash_i = -1
+    self.middle_brake_bound = -1
+    self.lower_brake_bound = -1
+    self.upper_brake_bound = -1
+    self.rollback = None
+    self.failed = False
+
+  def done(self):
+    return self.failed or self.i >= len(self.segments)
+
+  def shifting(self):
+    return self.shiftpt >= 0
+
+  def segment_next(self):
+    i = self.i
+    return self.segments[i+1] if i+1<len(self.segments) else self.segments[i]
+
+  def advance(self, step_result, better_gear=None):
+    # take in the step into segment i, step_result being what step() gave (None for a crash); the
+    # best gear at its velocity is looked up unless it's given
+    vehicle = self.vehicle
+    output = self.output
+    i = self.i
+
+    if step_result is None:
+      #print('crash at',i)
+      if not self.brake:
+        # Start braking
+        self.precrash_i = i
+        self.brake = True
+        self.bounds_found = False
+        self.failpt = i
+        # while segments[failpt-1].curvature < segments[failpt].curvature and failpt<len(segments):
+        #   failpt += 1
+        self.lower_brake_bound = i
+        i = self.lower_brake_bound
+        if self.envelope:
+          # one sweep back from the crash says where to brake from; braking runs once from there
+          self.lower_brake_bound = braking.envelope_start(vehicle, output, self.segments, i)
+          i = self.lower_brake_bound
+        # back up (enables bisection algorithm) only the rows braking from here on can overwrite
+        self.rollback = braking.RollbackWindow(output, i, self.precrash_i)
+      elif self.bounds_found:
+        self.upper_brake_bound = self.middle_brake_bound
+
+        self.middle_brake_bound = int((self.upper_brake_bound + self.lower_brake_bound) / 2)
+
+        i = self.middle_brake_bound
+        self.rollback.restore(output, i)
+      else:
+        # Try again from an earlier point; the envelope only misses by a little
+        self.lower_brake_bound-=1 if self.envelope else self.backup_amount
+        i = self.lower_brake_bound
+        self.rollback.restore(output, i)
+      # reset shifting params
+      self.gear = None
+      self.shiftpt = -1
+    elif i<=self.failpt:
+      output[i] = step_result
+      i+=1
+      self.brake = True
+      # reset shifting params; the gear goes back to the best one at the new velocity
+      self.gear = better_gear
+      self.shiftpt = -1
+      self.shift_v_req = 0
+    elif self.failpt>=0 and not self.bounds_found and not self.envelope:
+      self.bounds_found = True
+
+      self.upper_brake_bound = self.precrash_i-1 #lower_brake_bound+backup_amount
+
+      self.middle_brake_bound = int((self.upper_brake_bound+self.lower_brake_bound)/2)
+
+      i = self.middle_brake_bound
+      self.rollback.restore(output, i)
+    elif self.failpt>=0 and self.bounds_found and abs(self.lower_brake_bound - self.upper_brake_bound) > 1:
+      self.lower_brake_bound = self.middle_brake_bound
+
+      self.middle_brake_bound = int((self.upper_brake_bound+self.lower_brake_bound)/2)
+
+      i = self.middle_brake_bound
+      self.rollback.restore(output, i)
+    else:
+      # normal operation
+
+      # quit braking
+      self.brake = False # problematic??
+      self.failpt = -1
+      self.lower_brake_bound = -1
+      self.upper_brake_bound = -1
+      self.bounds_found = False
+
+      output[i] = step_result
+
+      if better_gear is None:
+        better_gear = vehicle.best_gear(output[i,O_VELOCITY], output[i,O_FF_REMAINING])
+
+      if self.shiftpt < 0 and self.gear != better_gear and output[i,O_STATUS]==S_ENG_LIM_ACC and output[i,O_VELOCITY]>self.shift_v_req:
+        self.gear += int((better_gear-self.gear)/abs(better_gear-self.gear))
+        self.shiftpt = i
+        self.shift_v_req = output[i,O_VELOCITY]*1.01
+      elif self.shiftpt < 0 and output[i,O_STATUS]==S_TOPPED_OUT and self.gear<len(vehicle.gears)-1:
+        self.gear += 1
+        self.shiftpt = i
+        self.shift_v_req = output[i,O_VELOCITY]*1.01
+
+      if self.shiftpt >= 0 and output[i,O_TIME] > output[self.shiftpt,O_TIME]+vehicle.shift_time:
+        self.shiftpt = -1
+        i-=1
+
+      i+=1
+
+    self.i = i
+    if i<0:
+      print('damnit bobby')
+      output[:] = np.nan
+      self.failed = True
+    elif i<len(self.segments) and (self.gear is None) and self.shiftpt < 0:
+      self.gear = vehicle.best_gear(output[i-1,O_VELOCITY], output[i,O_FF_REMAINING])
+
 class sim_onetire:
-  def __init__(self):
-    pass
+  def __init__(self, brake_search='bisect'):
+    # how solve finds where to start braking before a crash; see braking.py
+    if brake_search not in braking.BRAKE_SEARCHES:
+      raise ValueError("brake_search must be one of %s" % repr(braking.BRAKE_SEARCHES))
+    self.brake_search = brake_search
 
   def step(self, vehicle, prior_result, segment, segment_next, brake, shifting, gear):
     """
@@ -31,7 +192,7 @@ class sim_onetire:
     """
     # return self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
     if brake:
-      if abs(vehicle.downforce(prior_result[O_VELOCITY],AERO_BRK)-vehicle.downforce(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3 and abs(vehicle.drag(prior_result[O_VELOCITY],AERO_BRK)-vehicle.drag(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3: 
+      if not vehicle.aero_matters(prior_result[O_VELOCITY],AERO_BRK):
           return self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
       out_brk = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_BRK)
       out_nor = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
@@ -48,7 +209,7 @@ class sim_onetire:
       else:
         return None
     else:
-      if abs(vehicle.downforce(prior_result[O_VELOCITY],AERO_DRS)-vehicle.downforce(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3 and abs(vehicle.drag(prior_result[O_VELOCITY],AERO_DRS)-vehicle.drag(prior_result[O_VELOCITY],AERO_FULL)) < 1e-3: 
+      if not vehicle.aero_matters(prior_result[O_VELOCITY],AERO_DRS):
           return self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
       out_drs = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_DRS)
       out_nor = self.substep(vehicle, prior_result, segment, segment_next, brake, shifting, gear, AERO_FULL)
@@ -138,26 +299,9 @@ class sim_onetire:
 
     # Use bisection to generate tire limit for sustaining, since there is no explicit solution
     if (not brake and shifting != IN_PROGRESS and self.compute_excess(vehicle,segment_next,vf,aero_mode) < 0) or status==S_SUSTAINING:
-      vfu = min(vf*1.3, vfmax)
-      vfb = max(vf*0.5, vfmin)
-      vf = min(vf, vfmax)
-      excess = self.compute_excess(vehicle, segment_next, vf, aero_mode)
-
-      n = 50
-      while excess<1e-3 or excess>1e-1:
-        # print excess
-        if (excess<0):
-          vfu = vf
-        else:
-          vfb = vf
-        vf = (vfu+vfb)/2
-        n-=1
-        if n <= 0:
-          if excess<0:
-            return None
-          else:
-            break
-        excess = self.compute_excess(vehicle, segment_next, vf, aero_mode)
+      vf = self.sustain(vehicle, segment_next, vf, vfmax, vfmin, aero_mode)
+      if vf is None:
+        return None
 
       status = S_SUSTAINING
       a_long = (vf**2-v0**2)/2/segment.length
@@ -217,148 +361,223 @@ class sim_onetire:
 
     return output
 
+  def sustain(self, vehicle, segment, vf, vfmax, vfmin, aero_mode):
+    """
+    substep()'s bisection for the speed that sustains into segment, with a little grip left over
+    after drag. Returns None if it runs out of tries while still short of grip.
+    """
+    vfu = min(vf*1.3, vfmax)
+    vfb = max(vf*0.5, vfmin)
+    vf = min(vf, vfmax)
+    excess = self.compute_excess(vehicle, segment, vf, aero_mode)
+
+    n = 50
+    while excess<1e-3 or excess>1e-1:
+      # print excess
+      if (excess<0):
+        vfu = vf
+      else:
+        vfb = vf
+      vf = (vfu+vfb)/2
+      n-=1
+      if n <= 0:
+        if excess<0:
+          return None
+        else:
+          break
+      excess = self.compute_excess(vehicle, segment, vf, aero_mode)
+    return vf
+
   def compute_excess(self, vehicle, segment, vf, aero_mode):
     # Returns how much tire grip there is after that needed to overcome drag
     return vehicle.f_long_remain(4, vehicle.mass*vehicle.g+vehicle.downforce(vf, aero_mode), vehicle.mass*vf**2*derate_curvature(segment.curvature,vehicle.r_add))[0] - vehicle.drag(vf, aero_mode)
 
+  def step_lanes(self, stacked, vehicles, segments, track, prior, at, brake, shifting, gear, live):
+    """
+    step() for every lane of stacked (a lanes.VehicleLanes of vehicles) at once, each lane from its
+    own prior row into its own segment: at holds each lane's index into segments, and track the
+    segments' (curvature, length, sector) as arrays. brake, shifting, gear and live (the lanes still
+    going) are per lane. Returns the rows, which lanes got one (step() gives None for the others),
+    and the best gear at each row's velocity.
+    """
+    v2 = corner_arrays.square(prior[:,O_VELOCITY])
+    # full aero, and the mode step() tries against it where that makes a difference
+    modes = np.array([np.full(len(at), AERO_FULL), np.where(brake, AERO_BRK, AERO_DRS)])
+    tried = np.array([live, live & stacked.aero_matters(v2, modes[1])])
+    outputs, ok = self.substep_lanes(stacked, vehicles, segments, track, prior, at, brake, shifting, gear, modes, tried)
+
+    # braking takes the slower of the two, driving the faster, and either where the other skids off
+    velocities = outputs[:,:,O_VELOCITY]
+    better = np.where(brake, velocities[1] < velocities[0], velocities[1] > velocities[0])
+    alt = ok[1] & (~ok[0] | better)
+    rows = np.where(alt[:,np.newaxis], outputs[1], outputs[0])
+    return rows, ok[0] | alt, stacked.best_gear(stacked.engine_forces(rows[:,O_VELOCITY])[0])
+
+  def substep_lanes(self, stacked, vehicles, segments, track, prior, at, brake, shifting, gear, aero_mode, live):
+    # substep() for the lanes of step_lanes in each row of aero_mode, which has a mode per lane
+    curvatures, lengths, sectors = track
+    curvature = curvatures[at]
+    at_next = np.minimum(at+1, len(segments)-1)
+    length = lengths[at]
+    v0 = prior[:,O_VELOCITY]
+    v02 = corner_arrays.square(v0)
+    derated = derate_curvature(curvature, stacked.r_add)
+    drag = stacked.drag(v02, aero_mode)
+
+    with np.errstate(all='ignore'):
+      # How much grip is needed to keep the car from skidding away, and what's left of it
+      Ftire_lat = derated*stacked.mass*v02
+      N = stacked.mass*stacked.g + stacked.downforce(v02, aero_mode)
+      Ftire_remaining = stacked.f_long_remain(4, N, Ftire_lat)
+      ok = live & ~(Ftire_remaining < 0)
+
+      Ftire_engine_limit, eng_rpm = stacked.engine_force(v0, gear)
+
+      # driving, with substep()'s sustaining on a tightening corner out of braking or sustaining
+      sustain = (curvature > 0) & ((prior[:,O_CURVATURE] - curvature) >= 0) & ((prior[:,O_STATUS] == S_BRAKING) | (prior[:,O_STATUS] == S_SUSTAINING))
+      Ftire_long = np.where(sustain, drag, Ftire_engine_limit)
+      status = np.where(sustain, S_SUSTAINING, np.where(Ftire_long <= drag, S_DRAG_LIM, S_ENG_LIM_ACC))
+      tire_limited = Ftire_long > Ftire_remaining
+      status = np.where(tire_limited, S_TIRE_LIM_ACC, status)
+      Ftire_long = np.where(tire_limited, Ftire_remaining, Ftire_long)
+      status = np.where(eng_rpm > stacked.rpm_limit, S_TOPPED_OUT, status)
+
+      status = np.where(brake, S_BRAKING, np.where(shifting, S_SHIFTING, status))
+      Ftire_long = np.where(brake, -Ftire_remaining, np.where(shifting, 0.0, Ftire_long))
+
+      # Determine the longitudinal force and resulting vehicle acceleration
+      F_longitudinal = Ftire_long - drag
+      a_long = F_longitudinal / stacked.mass
+
+      vf = floor_sqrt_lanes(v02 + 2*a_long*length)
+      vfmax = floor_sqrt_lanes(v02 + 2*(Ftire_engine_limit - drag)/stacked.mass*length)
+      vfmin = floor_sqrt_lanes(v02 + 2*(-Ftire_remaining - drag)/stacked.mass*length)
+
+      # substep()'s bisection for the tire limit; its check against IN_PROGRESS passes exactly when
+      # shifting, as it gets shifting as a bool. The lanes are seldom all in a corner at once, so the
+      # few that sustain are bisected one by one rather than keeping every lane stepping until the
+      # slowest is done.
+      sustaining = ok & (status == S_SUSTAINING)
+      checked = ok & ~brake & shifting
+      if checked.any():
+        sustaining |= checked & (self.compute_excess_lanes(stacked, curvatures[at_next], vf, aero_mode) < 0)
+      if sustaining.any():
+        vf_sustain = vf.copy()
+        modes = np.broadcast_to(aero_mode, vf.shape)
+        for m, l in zip(*np.nonzero(sustaining)):
+          v = self.sustain(vehicles[l], segments[at_next[l]], float(vf[m,l]), float(vfmax[m,l]), float(vfmin[m,l]), int(modes[m,l]))
+          if v is None:
+            ok[m,l] = False
+          else:
+            vf_sustain[m,l] = v
+
+        vf = np.where(sustaining, vf_sustain, vf)
+        status = np.where(sustaining, S_SUSTAINING, status)
+        a_long = np.where(sustaining, (corner_arrays.square(vf)-v02)/2/length, a_long)
+
+      vavg = ((v0+vf)/2)
+      tf = np.where(vavg > 0, prior[:,O_TIME] + length/vavg, prior[:,O_TIME])
+      co2_elapsed = np.where(brake | shifting, prior[:,O_CO2], prior[:,O_CO2] + length*F_longitudinal*stacked.co2_factor/stacked.e_factor)
+
+    output = np.zeros(vf.shape + (O_MATRIX_COLS,))
+    output[...,O_TIME]     = tf
+    output[...,O_DISTANCE] = prior[:,O_DISTANCE] + length
+    output[...,O_VELOCITY] = vf
+    output[...,O_NR]       = N
+    output[...,O_SECTORS]  = sectors[at]
+    output[...,O_STATUS]   = status
+    output[...,O_GEAR]     = np.where(brake | shifting, np.nan, gear)
+    output[...,O_LONG_ACC] = a_long / stacked.g
+    output[...,O_LAT_ACC]  = v02 * derated / stacked.g
+    output[...,O_FR_REMAINING] = Ftire_remaining
+    output[...,O_CURVATURE] = curvature
+    output[...,O_ENG_RPM]   = eng_rpm
+    output[...,O_CO2]       = co2_elapsed
+    output[...,O_AERO_MODE] = aero_mode
+    return output, ok
+
+  def compute_excess_lanes(self, stacked, curvature, vf, aero_mode):
+    # compute_excess() for each lane, on its own segment's curvature
+    vf2 = corner_arrays.square(vf)
+    return stacked.f_long_remain(4, stacked.mass*stacked.g + stacked.downforce(vf2, aero_mode), stacked.mass*vf2*derate_curvature(curvature, stacked.r_add)) - stacked.drag(vf2, aero_mode)
+
   def solve(self, vehicle, segments, output_0 = None):
     logging.debug("Segments is %d long" % len(segments))
     logging.debug("Gear ratio is %.5f" % vehicle.final_drive_reduction)
-    # set up initial stuctures
-    output = np.zeros((len(segments), O_MATRIX_COLS))
-    precrash_output = np.zeros((len(segments), O_MATRIX_COLS))
-    shifting = NOT_SHIFTING
-    
-    if output_0 is None:
-      output[0,O_NF] = vehicle.mass*vehicle.g
-      gear = vehicle.best_gear(output[0,O_VELOCITY], np.inf)
-    else:
-      output[0,:] = output_0
-      output[0,O_TIME] = 0
-      output[0,O_DISTANCE] = 0
-      gear = vehicle.best_gear(output_0[O_VELOCITY], output_0[O_FR_REMAINING])
-
-    brake = False
-    shiftpt = -1
-    shift_v_req = 0
-    
-    step_result = self.step(vehicle, output[0], segments[0], segments[1], brake, shiftpt>=0, gear)
-
-    output[0] = step_result
-
-    # step loop set up
-    i = 1
-    backup_amount = int(7.0/segments[0].length)
-    bounds_found = False
-    failpt = -1
-    precrash_i = -1
-    middle_brake_bound = -1
-    lower_brake_bound = -1
-    upper_brake_bound = -1
-
-    while i<len(segments):
-      if i<0:
-        print('damnit bobby')
-        output[:] = np.nan 
-        return output
-      if (gear is None) and shiftpt < 0:
-        gear = vehicle.best_gear(output[i-1,O_VELOCITY], output[i,O_FF_REMAINING])
-
-      step_result = self.step(vehicle,output[i-1,:], segments[i], (segments[i+1] if i+1<len(segments) else segments[i]), brake, shiftpt>=0, gear)
-      if step_result is None:
-        #print('crash at',i)
-        if not brake:
-          # Start braking
-          del precrash_output
-          precrash_output = np.copy(output)
-          precrash_i = i
-          brake = True
-          bounds_found = False
-          failpt = i
-          # while segments[failpt-1].curvature < segments[failpt].curvature and failpt<len(segments):
-          #   failpt += 1
-          lower_brake_bound = i
-          i = lower_brake_bound
-        elif bounds_found:
-          upper_brake_bound = middle_brake_bound
-
-          middle_brake_bound = int((upper_brake_bound + lower_brake_bound) / 2)
-          
-          i = middle_brake_bound
-          del output
-          output = np.copy(precrash_output)
-        else:
-          # Try again from an earlier point
-          lower_brake_bound-=backup_amount
-          i = lower_brake_bound
-          del output
-          output = np.copy(precrash_output)
-        # reset shifting params
-        gear = None
-        shiftpt = -1
-      elif i<=failpt:
-        output[i] = step_result
-        i+=1
-        brake = True
-        # reset shifting params
-        gear = None
-        shiftpt = -1
-        shift_v_req = 0
-      elif failpt>=0 and not bounds_found:
-        bounds_found = True
-
-        upper_brake_bound = precrash_i-1 #lower_brake_bound+backup_amount
-
-        middle_brake_bound = int((upper_brake_bound+lower_brake_bound)/2)
-        
-        i = middle_brake_bound
-        del output
-        output = np.copy(precrash_output)
-      elif failpt>=0 and bounds_found and abs(lower_brake_bound - upper_brake_bound) > 1:
-        lower_brake_bound = middle_brake_bound
-
-        middle_brake_bound = int((upper_brake_bound+lower_brake_bound)/2)
-        
-        i = middle_brake_bound
-        del output
-        output = np.copy(precrash_output)
-      else:
-        # normal operation
+    lap = Lap(vehicle, segments, output_0, brake_search=self.brake_search)
 
-        # quit braking
-        brake = False # problematic??
-        failpt = -1
-        lower_brake_bound = -1
-        upper_brake_bound = -1
-        bounds_found = False
-
-        output[i] = step_result
-
-        better_gear = vehicle.best_gear(output[i,O_VELOCITY], output[i,O_FF_REMAINING])
+    # the first step can't back up, so whatever it gives goes in
+    lap.output[0] = self.step(vehicle, lap.output[0], segments[0], segments[1], lap.brake, lap.shifting(), lap.gear)
 
-        if shiftpt < 0 and gear != better_gear and output[i,O_STATUS]==S_ENG_LIM_ACC and output[i,O_VELOCITY]>shift_v_req:
-          gear += int((better_gear-gear)/abs(better_gear-gear))
-          shiftpt = i
-          shift_v_req = output[i,O_VELOCITY]*1.01
-        elif shiftpt < 0 and output[i,O_STATUS]==S_TOPPED_OUT and gear<len(vehicle.gears)-1:
-          gear += 1
-          shiftpt = i
-          shift_v_req = output[i,O_VELOCITY]*1.01
-
-        if shiftpt >= 0 and output[i,O_TIME] > output[shiftpt,O_TIME]+vehicle.shift_time:
-          shiftpt = -1
-          i-=1
-        
-        i+=1
+    n = len(segments)
+    while not lap.failed and lap.i < n:
+      i = lap.i
+      lap.advance(self.step(vehicle, lap.output[i-1,:], segments[i], (segments[i+1] if i+1<n else segments[i]), lap.brake, lap.shiftpt>=0, lap.gear))
 
     #np.savetxt('dump.csv', output, delimiter=",")
-    return output
+    return lap.output
 
   def steady_solve(self, vehicle, segments):
     output = self.solve(vehicle,segments)
     output[-1,O_VELOCITY] = output[-1,O_VELOCITY]*0.95
     return self.solve(vehicle,segments,output[-1, :])
 
+  def solve_lanes(self, vehicles, segments, output_0=None):
+    """
+    solve() for several vehicles at once (see lanes), with a Lap per vehicle. Each lap brakes, backs
+    up and shifts just as its own solve() would, so the lanes are seldom on the same segment; what
+    they share is the step, taken for all of them together from wherever each lap is.
+    Returns the output solve() would give for each vehicle.
+    """
+    if output_0 is None:
+      output_0 = [None for vehicle in vehicles]
+    if not lanes.stackable(vehicles):
+      return [self.solve(vehicle, segments, o) for vehicle, o in zip(vehicles, output_0)]
+    stacked = lanes.VehicleLanes(vehicles)
+    track = (np.array([segment.curvature for segment in segments], dtype=np.float64),
+      np.array([segment.length for segment in segments], dtype=np.float64),
+      np.array([segment.sector for segment in segments], dtype=np.float64))
+    outputs = np.zeros((len(vehicles), len(segments), O_MATRIX_COLS))
+    laps = [Lap(vehicle, segments, o, output, self.brake_search) for vehicle, o, output in zip(vehicles, output_0, outputs)]
+
+    # where each lap is and how it steps next, kept up to date lap by lap
+    lane = np.arange(len(laps))
+    at = np.zeros(len(laps), dtype=int)
+    brake = np.array([lap.brake for lap in laps])
+    shifting = np.array([lap.shifting() for lap in laps])
+    gear = np.array([lap.gear for lap in laps])
+    live = np.ones(len(laps), dtype=bool)
+
+    # the first step can't back up, so whatever it gives goes in
+    rows, ok, better_gears = self.step_lanes(stacked, vehicles, segments, track, outputs[:,0], at, brake, shifting, gear, live)
+    outputs[:,0] = np.where(ok[:,np.newaxis], rows, np.nan)
+
+    for l, lap in enumerate(laps):
+      at[l] = lap.i
+      live[l] = not lap.done()
+
+    while live.any():
+      rows, ok, better_gears = self.step_lanes(stacked, vehicles, segments, track, outputs[lane,at-1], at, brake, shifting, gear, live)
+      for l in np.nonzero(live)[0]:
+        lap = laps[l]
+        lap.advance(rows[l] if ok[l] else None, better_gears[l])
+        if lap.done():
+          live[l] = False
+          at[l] = 1
+        else:
+          at[l] = lap.i
+          brake[l] = lap.brake
+          shifting[l] = lap.shiftpt >= 0
+          gear[l] = lap.gear
+
+    return [lap.output for lap in laps]
+
+  def steady_solve_lanes(self, vehicles, segments):
+    outputs = self.solve_lanes(vehicles, segments)
+    for output in outputs:
+      output[-1,O_VELOCITY] = output[-1,O_VELOCITY]*0.95
+    return self.solve_lanes(vehicles, segments, [output[-1, :] for output in outputs])
+
   def colorgen(num_colors, idx):
     color_norm  = colors.Normalize(vmin=0, vmax=num_colors-1)
     scalar_map = cmx.ScalarMappable(norm=color_norm, cmap='hsv') 
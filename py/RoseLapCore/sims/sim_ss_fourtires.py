@@ -2,6 +2,8 @@ import numpy as np
 import math
 
 from constants import *
+from corner_cache import steady_corners, AERO_FIELDS, COMB_TIRE_FIELDS, AXLE_TIRE_FIELDS
+import corner_arrays
 import logging
 
 """
@@ -27,12 +29,21 @@ def frem_filter(x):
   return x
 
 class sim_ss_fourtires:
+  # vehicle fields steady_corner reads, directly or through Vehicle methods
+  corner_fields = ('mass', 'g', 'r_add', 'vmax', 'co2_factor', 'e_factor', 'moi_yaw', 'weight_bias', 'cg_height',
+    'wheelbase_length', 'cp_bias', 'cp_height', 'track_front', 'track_rear', 'k_chassis', 'k_roll_front',
+    'k_roll_rear', 'lltd') + AERO_FIELDS + AXLE_TIRE_FIELDS
+
   def __init__(self):
     pass
 
   def compute_Ff_Fr(self, N, vehicle, v, a_long, segment, prior_curvature):
-    alpha = v**2*(derate_curvature(segment.curvature, vehicle.r_add)-derate_curvature(prior_curvature, vehicle.r_add))/segment.length + segment.curvature*a_long
-    a_lat = derate_curvature(segment.curvature, vehicle.r_add)*v**2
+    return self.lateral_forces(N, vehicle, v**2, a_long, segment.curvature, segment.length, prior_curvature)
+
+  def lateral_forces(self, N, vehicle, v2, a_long, curvature, length, prior_curvature):
+    # compute_Ff_Fr given v**2, which lets it take arrays of corners
+    alpha = v2*(derate_curvature(curvature, vehicle.r_add)-derate_curvature(prior_curvature, vehicle.r_add))/length + curvature*a_long
+    a_lat = derate_curvature(curvature, vehicle.r_add)*v2
     kf = vehicle.k_roll_front
     kr = vehicle.k_roll_rear
     kcf = vehicle.k_chassis/(vehicle.weight_bias)
@@ -458,6 +469,9 @@ class sim_ss_fourtires:
     return channels, (v0-channels[0,O_VELOCITY] >= 1e-1) and (v0 != 0)
     
   def steady_corner(self, vehicle, sector):
+    return steady_corners.steady_corner(self, vehicle, sector, self.solve_steady_corner)
+
+  def solve_steady_corner(self, vehicle, sector):
     # solve a fuckton of physics
     v_lower = 0
     v_upper = vehicle.vmax
@@ -555,20 +569,80 @@ class sim_ss_fourtires:
     channels = np.array(channels)
     return channels
 
+  def steady_corner_batch(self, vehicle, sectors):
+    return steady_corners.steady_corner_batch(self, vehicle, sectors, self.solve_steady_corner_batch)
+
+  def solve_steady_corner_batch(self, vehicle, sectors):
+    # solve_steady_corner for all of sectors at once, one row of channels each
+    curvature, length, index = corner_arrays.corner_columns(sectors)
+    aero_mode = AERO_FULL
+    a_long = 0
+
+    def remaining(idx, v):
+      v2 = corner_arrays.square(v)
+      downforce = corner_arrays.downforce(vehicle, v2, aero_mode)
+      drag = corner_arrays.drag(vehicle, v2, aero_mode)
+
+      # Calculate normal force on each tire
+      Nf = ( (vehicle.weight_bias)*vehicle.g*vehicle.mass
+            + (vehicle.cp_bias[aero_mode])*downforce
+            - vehicle.mass*a_long*vehicle.cg_height/vehicle.wheelbase_length
+            - drag*vehicle.cp_height[aero_mode]/vehicle.wheelbase_length )
+      Nr = ( (1-vehicle.weight_bias)*vehicle.g*vehicle.mass
+          + downforce*(1 - vehicle.cp_bias[aero_mode])
+          + vehicle.mass*a_long*vehicle.cg_height/vehicle.wheelbase_length
+          + drag*vehicle.cp_height[aero_mode]/vehicle.wheelbase_length )
+
+      Nf1, Nf2, Nr1, Nr2, Ff_lat, Fr_lat, alpha, a_lat = self.lateral_forces([Nf,Nr], vehicle, v2, a_long, curvature[idx], length[idx], curvature[idx])
+
+      # Calculate how much grip there is left
+      remaining_long_grip = (vehicle.f_long_remain_pair_array([Nf1,Nf2], Ff_lat, True)[0]
+        + vehicle.f_long_remain_pair_array([Nr1,Nr2], Fr_lat, False)[0])
+
+      # the rear tire with more grip covers the drag, the other one whatever it can't
+      F_req_long = drag
+      swap = remaining_long_grip[2] > remaining_long_grip[3]
+      big = np.where(swap, remaining_long_grip[2], remaining_long_grip[3])
+      small = np.where(swap, remaining_long_grip[3], remaining_long_grip[2])
+      short = big < F_req_long
+      small = np.where(short, small - (F_req_long - big), small)
+      big = np.where(short, 0.0, big - F_req_long)
+      remaining_long_grip[2] = np.where(swap, big, small)
+      remaining_long_grip[3] = np.where(swap, small, big)
+
+      rlg = remaining_long_grip[0]
+      for r in remaining_long_grip[1:]:
+        rlg = corner_arrays.py_min(rlg, r)
+
+      return rlg, (Nf1, Nf2, Nr1, Nr2, a_lat, F_req_long) + tuple(remaining_long_grip)
+
+    v, kept = corner_arrays.bisect_corners(vehicle.vmax, len(curvature), remaining, 1e-3, 1e-1)
+    Nf1, Nf2, Nr1, Nr2, a_lat, F_req_long = kept[:6]
+
+    channels = corner_arrays.corner_channels(vehicle, curvature, length, index, v, a_lat, F_req_long)
+    channels[:,O_NF] = Nf1
+    channels[:,O_NF2] = Nf2
+    channels[:,O_NR] = Nr1
+    channels[:,O_NR2] = Nr2
+    channels[:,O_FF_REMAINING:O_FR2_REMAINING+1] = np.stack(kept[6:], axis=1)
+    return channels
+
   def solve(self, vehicle, sectors, output_0 = None, dl=0.2, closed_loop=False):
     # print('Sectors: %s' % repr(sectors))
     # print('Total Length: %f' % sum([x.length for x in sectors]))
 
     # solve all the corners
-    steady_conditions = [None for i in sectors]
+    steady_conditions = self.steady_corner_batch(vehicle, sectors)
     steady_velocities = [vehicle.vmax for i in sectors]
-    for i, sector in enumerate(sectors):
-      if sector.curvature > 0:
-        steady_conditions[i] = self.steady_corner(vehicle, sector)
-        steady_velocities[i] = steady_conditions[i][O_VELOCITY]
+    for i, conditions in enumerate(steady_conditions):
+      if conditions is not None:
+        steady_velocities[i] = conditions[O_VELOCITY]
     # print('Steady velocities: %s' % repr(steady_velocities))
 
-    channel_stack = None
+    # drive() and brake() both give a sector int(length/dl) rows, so every sector has a fixed
+    # slot in the lap and brake solutions can be written over the drive they replace
+    channel_stack = np.zeros((sum([int(sector.length/dl) for sector in sectors]), O_MATRIX_COLS))
+    filled = 0
     starts = []
 
     if closed_loop:
@@ -610,7 +684,8 @@ class sim_ss_fourtires:
         dl, start=True)
 
       starts.append(0)
-      channel_stack = channels_corner
+      channel_stack[:channels_corner.shape[0],:] = channels_corner
+      filled = channels_corner.shape[0]
     else:
       channels_corner, failed_start = self.drive(vehicle,
         sectors[0],
@@ -620,7 +695,8 @@ class sim_ss_fourtires:
         dl, start=True)
 
       starts.append(0)
-      channel_stack = channels_corner
+      channel_stack[:channels_corner.shape[0],:] = channels_corner
+      filled = channels_corner.shape[0]
 
     i = 1
     while i<len(sectors):
@@ -634,20 +710,23 @@ class sim_ss_fourtires:
 
       channels_corner, failed_start = self.drive(vehicle,
         sectors[i],
-        channel_stack[-1,:],
+        channel_stack[filled-1,:],
         vf,
         steady_velocities[i], dl)
       # print(channels_corner)
 
-      starts.append(channel_stack.shape[0])
-      channel_stack = np.vstack((channel_stack,channels_corner))
+      starts.append(filled)
+      channel_stack[filled:filled+channels_corner.shape[0],:] = channels_corner
+      filled += channels_corner.shape[0]
 
       j = i-1
       failed_start = False
       ### DIDNT SUCCEED IN BRAKING ###
-      while failed_start:
+      # back past the first sector there's nothing left to brake through; the lap is left with a
+      # failed start there, as the first sector's drive leaves one
+      while failed_start and j >= 0:
         ### KEEP WORKING BACKWARDS... ###
-        # print('working backwards... (sec %d, x=%.1f)' % (j,channel_stack[-1,O_DISTANCE]))
+        # print('working backwards... (sec %d, x=%.1f)' % (j,channel_stack[filled-1,O_DISTANCE]))
         k = j
         vstart = channels_corner[0,O_VELOCITY]
         if steady_velocities[k] < vstart:
@@ -664,19 +743,9 @@ class sim_ss_fourtires:
         dt = (channels_corner[-1,O_TIME] - channels_corner[0,O_TIME]) - (channel_stack[starts[j+1],O_TIME]-channel_stack[starts[j],O_TIME])
 
         failed_start = not success
-        after = channel_stack[starts[j+1]:,:]
-        after[:,O_TIME] += dt
-
-        channel_stack = np.vstack((channel_stack[:starts[j],:], channels_corner))
-        channel_stack = np.vstack((channel_stack, after))
-
-        di = (channels_corner.shape[0]) - (starts[j+1]-starts[j])
-        # print('Delta i = %d' % di)
-        k = j+1
-        while k < len(starts):
-          starts[k] += di
-          k+=1
-        
+        channel_stack[starts[j+1]:filled,O_TIME] += dt
+        channel_stack[starts[j]:starts[j+1],:] = channels_corner
+
         j-=1
 
       i+=1
@@ -2,6 +2,9 @@ import numpy as np
 import math
 
 from constants import *
+from corner_cache import steady_corners, AERO_FIELDS, COMB_TIRE_FIELDS, AXLE_TIRE_FIELDS
+import corner_arrays
+import lanes
 import logging
 
 """
@@ -27,10 +30,105 @@ def frem_filter(x):
   return x
 
 class sim_ss_onetire:
-  def __init__(self):
-    pass
+  # vehicle fields steady_corner reads, directly or through Vehicle methods
+  corner_fields = ('mass', 'g', 'r_add', 'vmax', 'co2_factor', 'e_factor') + AERO_FIELDS + COMB_TIRE_FIELDS
+
+  def __init__(self, analytic=False):
+    # analytic: brake on straights with the closed form of the step below instead of stepping
+    self.analytic = analytic
+
+  def braking_regime(self, vehicle, sector):
+    """
+    On a straight the tires put all of their grip into braking, and both that grip and the drag
+    are linear in v**2, so each backwards step below is v**2 -> v**2 + 2*dl*(A + B*v**2).
+    Returns (A, B, aero_mode), or None where that doesn't hold and braking has to be stepped.
+    """
+    if not self.analytic or sector.curvature != 0:
+      return None
+    if vehicle.comb_tire_mu_x < 0 or vehicle.downforce_35mph[AERO_FULL] < 0:
+      return None
+    if vehicle.comb_tire_mu_x*(vehicle.mass*vehicle.g/4) + vehicle.comb_tire_offset_x <= 0:
+      return None
+    if vehicle.comb_tire_mu_y < 0 or vehicle.comb_tire_mu_y*(vehicle.mass*vehicle.g/4) + vehicle.comb_tire_offset_y < 0:
+      return None
+
+    # the stepper airbrakes whenever that drags more, which on a straight is at any speed or none
+    aero_mode = AERO_BRK if vehicle.drag_35mph[AERO_BRK] > vehicle.drag_35mph[AERO_FULL] else AERO_FULL
+    A = (vehicle.comb_tire_mu_x*vehicle.mass*vehicle.g + 4*vehicle.comb_tire_offset_x)/vehicle.mass
+    B = (vehicle.comb_tire_mu_x*vehicle.downforce_35mph[AERO_FULL] + vehicle.drag_35mph[aero_mode])/(51.33333 ** 2)/vehicle.mass
+    return (A, B, aero_mode)
+
+  def braking_curve(self, regime, v, steps, dl):
+    # v**2 after 0..steps backwards braking steps from v, summing the geometric series
+    A, B, aero_mode = regime
+    k = np.arange(steps+1)
+    if B > 0:
+      return v**2 + np.expm1(k*np.log1p(2*dl*B))*(v**2 + A/B)
+    return v**2 + k*(2*dl*A)
+
+  def braking_rows(self, vehicle, sector, channels, rows, u, aero_mode, x, dl):
+    # fill rows (in the order they are stepped through) from v**2 before and after each step
+    v = np.sqrt(u[1:])
+    N = vehicle.mass*vehicle.g + corner_arrays.downforce(vehicle, u[:-1], aero_mode)
+    F_tire_long_available = vehicle.f_long_remain_array(4, vehicle.mass*vehicle.g + corner_arrays.downforce(vehicle, u[:-1], AERO_FULL), 0.0)[0]
+    a_long = (- F_tire_long_available - corner_arrays.drag(vehicle, u[:-1], aero_mode)) / vehicle.mass
+
+    with np.errstate(divide='ignore'):
+      t = np.cumsum(-np.where(v==0, 1000, dl/v))
+
+    channels[rows,O_TIME]     = t
+    channels[rows,O_DISTANCE] = np.cumsum(np.concatenate(([x], np.full(len(rows), -dl))))[1:]
+    channels[rows,O_VELOCITY] = v
+    channels[rows,O_NR]       = N
+    channels[rows,O_SECTORS]  = sector.i
+    channels[rows,O_STATUS]   = S_BRAKING
+    channels[rows,O_LONG_ACC] = a_long/vehicle.g
+    channels[rows,O_LAT_ACC]  = 0
+    channels[rows,O_FR_REMAINING] = 0
+    channels[rows,O_CURVATURE] = sector.curvature
+    channels[rows,O_ENG_RPM]   = np.nan
+    channels[rows,O_CO2]       = 0
+    channels[rows,O_AERO_MODE] = aero_mode
+    return t[-1] if len(rows) > 0 else 0
+
+  def brake_straight(self, vehicle, sector, t0, xf, v0, vf, regime, dl=0.1):
+    # brake() on a straight, in bulk
+    n = int(sector.length/dl)
+    channels = np.zeros((n, O_MATRIX_COLS))
+    u = self.braking_curve(regime, vf, n, dl)
+
+    # braking succeeds on the first step that would overshoot v0; from there on it holds v0
+    over = np.nonzero(np.sqrt(u[1:]) > v0)[0]
+    success = len(over) > 0
+    m = over[0]+1 if success else n
+
+    rows = np.arange(n-1, n-1-m, -1)
+    t = self.braking_rows(vehicle, sector, channels, rows, u[:m+1], regime[2], xf, dl)
+    channels[rows,O_GEAR] = np.nan
+    if success:
+      i = rows[-1]
+      channels[i,O_VELOCITY]  = v0
+      channels[i,O_STATUS]    = S_SUSTAINING
+      channels[i,O_AERO_MODE] = AERO_FULL
+      channels[:i+1,:] = np.tile(channels[i,:], (i+1,1))
+      # the step that reached v0 is timed like any other, the ones held at v0 with a plain dl/v0 as in brake()
+      with np.errstate(divide='ignore'):
+        dt = np.full(i+1, -(np.float64(dl)/v0))
+      dt[0] = -(1000 if v0==0 else dl/v0)
+      t = channels[i+1,O_TIME] if i+1 < n else 0
+      x = channels[i+1,O_DISTANCE] if i+1 < n else xf
+      channels[i::-1,O_TIME] = np.cumsum(np.concatenate(([t], dt)))[1:]
+      channels[i::-1,O_DISTANCE] = np.cumsum(np.concatenate(([x], np.full(i+1, -dl))))[1:]
+      t = channels[0,O_TIME]
+
+    channels[:,O_TIME] += t0 - t
+    return channels, success
 
   def brake(self, vehicle, sector, t0, xf, v0, vf, dl=0.1):
+    regime = self.braking_regime(vehicle, sector)
+    if regime is not None:
+      return self.brake_straight(vehicle, sector, t0, xf, v0, vf, regime, dl)
+
     n = int(sector.length/dl)
     channels = np.zeros((n, O_MATRIX_COLS))
     v = vf
@@ -195,12 +293,32 @@ class sim_ss_onetire:
           channels[j,O_DISTANCE] += dl*(j-i)
         break
 
+    return self.finish_drive(vehicle, sector, channels, x0, t0, v0, v, vf, vmax, gear, dl)
+
+  def finish_drive(self, vehicle, sector, channels, x0, t0, v0, v, vf, vmax, gear, dl):
+    # the rest of drive() once the forward integration has filled channels and reached v
+    n = channels.shape[0]
 
     # perform reverse integration to the beginning or vmax
 
-    if vmax-vf > 1e-1 and v>vf:
+    regime = self.braking_regime(vehicle, sector)
+    if vmax-vf > 1e-1 and v>vf and regime is not None:
+      # on a straight the braking curve comes in one go; it runs until it meets the drive
+      u = self.braking_curve(regime, vf, n-1, dl)
+      rows = np.arange(n-2, -1, -1)
+      met = np.nonzero(np.sqrt(u[1:]) > channels[rows,O_VELOCITY])[0]
+      m = met[0] if len(met) > 0 else n-1
+
+      t = self.braking_rows(vehicle, sector, channels, rows[:m], u[:m+1], regime[2], x0+dl*n, dl)
+      channels[rows[:m],O_GEAR] = gear
+      channels[-1,:] = channels[-2,:]
+      channels[-1,O_TIME]     = -1e-10
+      channels[-1,O_DISTANCE] = x0 + dl*n
+      channels[-1,O_VELOCITY] = vf
+      braked = channels[:,O_TIME] < 0
+      channels[braked,O_TIME] += (channels[rows[m],O_TIME] if len(met) > 0 else t0) - t
+    elif vmax-vf > 1e-1 and v>vf:
       # print('doing braking... %f -> %f' % (v,vf))
-      t_peak = t
       v = vf
       t = 0
       x = x0+dl*n
@@ -270,6 +388,9 @@ class sim_ss_onetire:
           if channels[j,O_TIME] < 0:
             channels[j,O_TIME] += t0 - t
     
+    return self.drive_result(channels, v0, vf, vmax)
+
+  def drive_result(self, channels, v0, vf, vmax):
     if abs(channels[-1,O_VELOCITY] - min(vf,vmax)) < 1:
       channels[-1,O_VELOCITY] = min(vf,vmax)
 
@@ -280,6 +401,9 @@ class sim_ss_onetire:
     return channels, (v0-channels[0,O_VELOCITY] >= 1e-1) and (v0 != 0)
     
   def steady_corner(self, vehicle, sector):
+    return steady_corners.steady_corner(self, vehicle, sector, self.solve_steady_corner)
+
+  def solve_steady_corner(self, vehicle, sector):
     # solve a fuckton of physics
     v_lower = 0
     v_upper = vehicle.vmax
@@ -350,21 +474,46 @@ class sim_ss_onetire:
 
     return channels
 
+  def steady_corner_batch(self, vehicle, sectors):
+    return steady_corners.steady_corner_batch(self, vehicle, sectors, self.solve_steady_corner_batch)
+
+  def solve_steady_corner_batch(self, vehicle, sectors):
+    # solve_steady_corner for all of sectors at once, one row of channels each
+    curvature, length, index = corner_arrays.corner_columns(sectors)
+    k = derate_curvature(curvature, vehicle.r_add)
+
+    def excess(idx, v):
+      v2 = corner_arrays.square(v)
+      N = vehicle.mass*vehicle.g + corner_arrays.downforce(vehicle, v2, AERO_FULL)
+      F_tire_long = corner_arrays.drag(vehicle, v2, AERO_FULL)
+      a_lat = v2 * k[idx]
+      F_tire_lat_excess = vehicle.f_lat_remain_array(4, N, F_tire_long)[0] - vehicle.mass * a_lat
+      return F_tire_lat_excess, (N, F_tire_long, a_lat, F_tire_lat_excess)
+
+    v, (N, F_tire_long, a_lat, F_tire_lat_excess) = corner_arrays.bisect_corners(vehicle.vmax, len(k), excess, 1e-1, 2e-1)
+
+    channels = corner_arrays.corner_channels(vehicle, curvature, length, index, v, a_lat, F_tire_long)
+    channels[:,O_NR] = N
+    channels[:,O_FR_REMAINING] = F_tire_lat_excess
+    return channels
+
   def solve(self, vehicle, sectors, output_0 = None, dl=0.2, closed_loop=False):
     # print('Sectors: %s' % repr(sectors))
     # print('Total Length: %f' % sum([x.length for x in sectors]))
 
     # solve all the corners
-    steady_conditions = [None for i in sectors]
+    steady_conditions = self.steady_corner_batch(vehicle, sectors)
     steady_velocities = [vehicle.vmax for i in sectors]
-    for i, sector in enumerate(sectors):
-      if sector.curvature > 0:
-        steady_conditions[i] = self.steady_corner(vehicle, sector)
-        steady_velocities[i] = steady_conditions[i][O_VELOCITY]
+    for i, conditions in enumerate(steady_conditions):
+      if conditions is not None:
+        steady_velocities[i] = conditions[O_VELOCITY]
     # print('Steady velocities: %s' % repr(steady_velocities))
 
 
-    channel_stack = None
+    # drive() and brake() both give a sector int(length/dl) rows, so every sector has a fixed
+    # slot in the lap and brake solutions can be written over the drive they replace
+    channel_stack = np.zeros((sum([int(sector.length/dl) for sector in sectors]), O_MATRIX_COLS))
+    filled = 0
     starts = []
 
     if closed_loop:
@@ -385,7 +534,8 @@ class sim_ss_onetire:
         np.nan, dl, start=False)
 
       starts.append(0)
-      channel_stack = channels_corner
+      channel_stack[:channels_corner.shape[0],:] = channels_corner
+      filled = channels_corner.shape[0]
     else:
       channels_corner, failed_start = self.drive(vehicle,
         sectors[0],
@@ -397,7 +547,8 @@ class sim_ss_onetire:
         np.nan, dl, start=True)
 
       starts.append(0)
-      channel_stack = channels_corner
+      channel_stack[:channels_corner.shape[0],:] = channels_corner
+      filled = channels_corner.shape[0]
 
     i = 1
     while i<len(sectors):
@@ -411,51 +562,18 @@ class sim_ss_onetire:
 
       channels_corner, failed_start = self.drive(vehicle,
         sectors[i],
-        channel_stack[-1,O_DISTANCE],
-        channel_stack[-1,O_TIME],
-        channel_stack[-1,O_VELOCITY],
+        channel_stack[filled-1,O_DISTANCE],
+        channel_stack[filled-1,O_TIME],
+        channel_stack[filled-1,O_VELOCITY],
         vf,
         steady_velocities[i],
-        channel_stack[-1,O_GEAR], dl)
-
-      starts.append(channel_stack.shape[0])
-      channel_stack = np.vstack((channel_stack,channels_corner))
-
-      j = i-1
-      ### DIDNT SUCCEED IN BRAKING ###
-      while failed_start:
-        ### KEEP WORKING BACKWARDS... ###
-        # print('working backwards... (sec %d)' % j)
-        k = j
-        vstart = channels_corner[0,O_VELOCITY]
-        if steady_velocities[k] < vstart:
-          vstart = steady_velocities[k]
-        
-        channels_corner, success = self.brake(vehicle,
-          sectors[j],
-          channel_stack[starts[j],O_TIME],
-          channels_corner[0,O_DISTANCE],
-          vstart,
-          channels_corner[0,O_VELOCITY],
-          dl)
-        failed_start = not success
-
-        dt = (channels_corner[-1,O_TIME] - channels_corner[0,O_TIME]) - (channel_stack[starts[j+1],O_TIME]-channel_stack[starts[j],O_TIME])
-
-        failed_start = not success
-        after = channel_stack[starts[j+1]:,:]
-        after[:,O_TIME] += dt
-
-        channel_stack = np.vstack((channel_stack[:starts[j],:], channels_corner))
-        channel_stack = np.vstack((channel_stack, after))
-
-        di = (channels_corner.shape[0]) - (starts[j+1]-starts[j])
-        k = j+1
-        while k < len(starts):
-          starts[k] += di
-          k+=1
-        
-        j-=1
+        channel_stack[filled-1,O_GEAR], dl)
+
+      starts.append(filled)
+      channel_stack[filled:filled+channels_corner.shape[0],:] = channels_corner
+      filled += channels_corner.shape[0]
+
+      self.brake_back(vehicle, sectors, steady_velocities, channel_stack, starts, filled, channels_corner, failed_start, i, dl)
 
       i+=1
 
@@ -463,5 +581,425 @@ class sim_ss_onetire:
 
     return channel_stack
 
+  def brake_back(self, vehicle, sectors, steady_velocities, channel_stack, starts, filled, channels_corner, failed_start, i, dl):
+    # when the drive through sector i couldn't brake down to its start, brake through the sectors before it
+    j = i-1
+    ### DIDNT SUCCEED IN BRAKING ###
+    # back past the first sector there's nothing left to brake through; the lap is left with a
+    # failed start there, as the first sector's drive leaves one
+    while failed_start and j >= 0:
+      ### KEEP WORKING BACKWARDS... ###
+      # print('working backwards... (sec %d)' % j)
+      k = j
+      vstart = channels_corner[0,O_VELOCITY]
+      if steady_velocities[k] < vstart:
+        vstart = steady_velocities[k]
+      
+      channels_corner, success = self.brake(vehicle,
+        sectors[j],
+        channel_stack[starts[j],O_TIME],
+        channels_corner[0,O_DISTANCE],
+        vstart,
+        channels_corner[0,O_VELOCITY],
+        dl)
+      failed_start = not success
+
+      dt = (channels_corner[-1,O_TIME] - channels_corner[0,O_TIME]) - (channel_stack[starts[j+1],O_TIME]-channel_stack[starts[j],O_TIME])
+
+      failed_start = not success
+      channel_stack[starts[j+1]:filled,O_TIME] += dt
+      channel_stack[starts[j]:starts[j+1],:] = channels_corner
+
+      j-=1
+
+  def brake_back_lanes(self, stacked, vehicles, sectors, steady_velocities, channel_stack, starts, filled, drives, i, dl):
+    # brake_back() for every lane at once, drives being drive_lanes()'s result for sector i
+    failed = np.array([failed_start for channels_corner, failed_start in drives], dtype=bool)
+    # the first row of what each lane put in last
+    first = np.array([channels_corner[0] if failed_start else np.zeros(O_MATRIX_COLS) for channels_corner, failed_start in drives])
+    j = i-1
+    while failed.any() and j >= 0:
+      vstart = first[:,O_VELOCITY]
+      steady = np.array([velocities[j] for velocities in steady_velocities])
+      vstart = np.where(steady < vstart, steady, vstart)
+
+      channels, success = self.brake_lanes(stacked, vehicles,
+        sectors[j],
+        channel_stack[:,starts[j],O_TIME],
+        first[:,O_DISTANCE],
+        vstart,
+        first[:,O_VELOCITY],
+        failed, dl)
+
+      dt = (channels[:,-1,O_TIME] - channels[:,0,O_TIME]) - (channel_stack[:,starts[j+1],O_TIME]-channel_stack[:,starts[j],O_TIME])
+      channel_stack[failed,starts[j+1]:filled,O_TIME] += dt[failed,np.newaxis]
+      channel_stack[failed,starts[j]:starts[j+1],:] = channels[failed]
+      first[failed] = channels[failed,0]
+
+      failed &= ~success
+      j-=1
+
+  def brake_lanes(self, stacked, vehicles, sector, t0, xf, v0, vf, braking, dl):
+    """
+    brake() for the lanes in braking at once, with everything from t0 on given per lane. Returns
+    brake()'s channels and success for each lane; the other lanes are left with zeros.
+    """
+    n = int(sector.length/dl)
+    n_lanes = len(vehicles)
+    channels = np.zeros((n_lanes, n, O_MATRIX_COLS))
+    success = np.zeros(n_lanes, dtype=bool)
+
+    # the lanes with closed form braking (see braking_regime) go one by one
+    going = braking.copy()
+    for l in np.nonzero(braking)[0]:
+      if self.braking_regime(vehicles[l], sector) is not None:
+        channels[l], success[l] = self.brake(vehicles[l], sector, t0[l], xf[l], v0[l], vf[l], dl)
+        going[l] = False
+    stepped = going.copy()
+
+    v = np.array(vf, dtype=np.float64)
+    t = np.zeros(n_lanes)
+    x = np.array(xf, dtype=np.float64)
+    curvature = derate_curvature(sector.curvature, stacked.r_add)
+    weight = stacked.mass*stacked.g
+    modes = np.array([[AERO_FULL], [AERO_BRK]])
+
+    with np.errstate(all='ignore'):
+      for i in reversed(range(n)):
+        if not going.any():
+          break
+        v2 = corner_arrays.square(v)
+        a_lat = v2 * curvature
+        F_tire_lat = stacked.mass * a_lat
+
+        # airbrake until braking succeeds, whenever that drags more; the tires stay at what they give with full aero
+        N = weight + stacked.downforce(v2, modes)
+        drag = stacked.drag(v2, modes)
+        F_tire_long_available_FULL = stacked.f_long_remain(4, N[0], F_tire_lat)
+        F_longitudinal_FULL = - F_tire_long_available_FULL - drag[0]
+        F_longitudinal_BRK = - F_tire_long_available_FULL - drag[1]
+        airbrake = ~success & (F_longitudinal_FULL > F_longitudinal_BRK)
+        aero_mode = np.where(airbrake, AERO_BRK, AERO_FULL)
+        F_longitudinal = np.where(airbrake, F_longitudinal_BRK, F_longitudinal_FULL)
+        N = np.where(airbrake, N[1], N[0])
+
+        status = np.where(success, S_SUSTAINING, S_BRAKING)
+        a_long = F_longitudinal / stacked.mass
+        u = v2 - 2*a_long*dl
+        v = np.where(u > 0, np.sqrt(u), 0.0)
+
+        # braking succeeds on the first step that would overshoot v0; from there on it holds v0
+        success |= going & (v > v0)
+        aero_mode = np.where(success, AERO_FULL, aero_mode)
+        v = np.where(success, v0, v)
+
+        t = t - np.where(v == 0, 1000, dl/v)
+        x = x - dl
+
+        row = np.zeros((n_lanes, O_MATRIX_COLS))
+        row[:,O_TIME]     = t
+        row[:,O_DISTANCE] = x
+        row[:,O_VELOCITY] = v
+        row[:,O_NR]       = N
+        row[:,O_SECTORS]  = sector.i
+        row[:,O_STATUS]   = status
+        row[:,O_GEAR]     = np.nan
+        row[:,O_LONG_ACC] = a_long/stacked.g
+        row[:,O_LAT_ACC]  = a_lat/stacked.g
+        row[:,O_CURVATURE] = sector.curvature
+        row[:,O_ENG_RPM]   = np.nan
+        row[:,O_AERO_MODE] = aero_mode
+        channels[going,i,:] = row[going]
+
+        # past the third row brake() holds v0 the rest of the way back and stops stepping
+        held = going & success if i > 2 else going & False
+        for l in np.nonzero(held)[0]:
+          channels[l,i,O_STATUS] = S_SUSTAINING
+          channels[l,:i,:] = np.tile(channels[l,i,:], (i,1))
+          channels[l,i-1::-1,O_TIME] = np.cumsum(np.concatenate(([t[l]], np.full(i, -(dl/v[l])))))[1:]
+          channels[l,i-1::-1,O_DISTANCE] = np.cumsum(np.concatenate(([x[l]], np.full(i, -dl))))[1:]
+          t[l] = channels[l,0,O_TIME]
+        going &= ~held
+
+      for l in np.nonzero(stepped)[0]:
+        channels[l,:,O_TIME] += t0[l] - t[l]
+    return channels, success
+
+  def drive_lanes(self, stacked, vehicles, sector, x0, t0, v0, vf, vmax, gear, dl=0.1):
+    """
+    drive() for every lane of stacked (a lanes.VehicleLanes of vehicles) at once, with everything
+    from x0 on given per lane. Returns drive()'s (channels, failed_start) for each lane.
+    """
+    n = int(sector.length / dl)
+    n_lanes = len(vehicles)
+    channels = np.zeros((n_lanes, n, O_MATRIX_COLS))
+
+    # perform forward integration to the end
+    v = np.array(v0, dtype=np.float64)
+    t = np.array(t0, dtype=np.float64)
+    x = np.array(x0, dtype=np.float64)
+    vmax = np.array(vmax, dtype=np.float64)
+    gear = np.array(gear, dtype=np.float64)
+    gear = np.where(np.isnan(gear), stacked.best_gear(stacked.engine_forces(v)[0]), gear)
+    topped = np.zeros(n_lanes, dtype=bool)
+    t_shift = np.full(n_lanes, -1.0)
+    v_shift = np.full(n_lanes, -1.0)
+
+    # where drive() would break out at top speed; a lane keeps stepping after that, and its rows
+    # from there on are put right once the rest are done
+    stopped = np.full(n_lanes, n)
+    v_stopped = np.zeros(n_lanes)
+    gear_stopped = np.zeros(n_lanes)
+
+    curvature = derate_curvature(sector.curvature, stacked.r_add)
+    weight = stacked.mass*stacked.g
+    vmax2 = corner_arrays.square(vmax)
+    modes = np.array([[AERO_DRS], [AERO_FULL]])
+
+    with np.errstate(all='ignore'):
+      for i in range(n):
+        v2 = corner_arrays.square(v)
+        a_lat = v2 * curvature
+        F_tire_lat = stacked.mass * a_lat
+
+        engine_forces, crank_rpms = stacked.engine_forces(v)
+        best_gear = stacked.best_gear(engine_forces)
+        shift = (best_gear != gear) & (v > v_shift)
+        gear = np.where(shift, gear + np.sign(best_gear - gear), gear)
+        t_shift = np.where(shift, t + stacked.shift_time, t_shift)
+        v_shift = np.where(shift, v*1.01, v_shift)
+        gear_i = gear.astype(int)
+        F_tire_engine_limit = stacked.in_gear(engine_forces, gear_i)
+        eng_rpm = stacked.in_gear(crank_rpms, gear_i)
+
+        # DRS unless full aero leaves the tires short of what the engine gives
+        N = weight + stacked.downforce(v2, modes)
+        F_tire_long_available = stacked.f_long_remain(4, N, F_tire_lat)
+        full = F_tire_long_available[0] < F_tire_engine_limit
+        aero_mode = np.where(full, AERO_FULL, AERO_DRS)
+        N = np.where(full, N[1], N[0])
+        F_tire_long_available = np.where(full, F_tire_long_available[1], F_tire_long_available[0])
+
+        # no power while shifting
+        shifting = t < t_shift
+        t_shift = np.where(~shifting & (t_shift > 0), -1.0, t_shift)
+        tire_limited = F_tire_engine_limit > F_tire_long_available
+        F_tire_long = np.where(shifting, 0.0, np.where(tire_limited, F_tire_long_available, F_tire_engine_limit))
+        status = np.where(tire_limited, S_TIRE_LIM_ACC, S_ENG_LIM_ACC)
+        status = np.where((eng_rpm > stacked.rpm_limit) & (gear >= stacked.n_gears-1), S_TOPPED_OUT, status)
+        status = np.where(shifting, S_SHIFTING, status)
+
+        F_longitudinal = F_tire_long - stacked.drag(v2, aero_mode)
+        a_long = F_longitudinal / stacked.mass
+        u = v2 + 2*a_long*dl
+        v = np.where(u > 0, np.sqrt(u), 0.0)
+        over = v > vmax
+        v = np.where(over, vmax, v)
+        a_long = np.where(over, (vmax2-v2)/2/dl, a_long)
+        F_tire_long = np.where(over, stacked.mass*a_long + stacked.drag(vmax2, aero_mode), F_tire_long)
+        topped |= over
+        t = t + np.where(v == 0, 1000, dl/v)
+        x = x + dl
+
+        F_tire_long_remaining = F_tire_long_available-np.abs(F_tire_long)
+        channels[:,i,O_TIME]      = t
+        channels[:,i,O_DISTANCE]  = x
+        channels[:,i,O_VELOCITY]  = v
+        channels[:,i,O_NR]        = N
+        channels[:,i,O_SECTORS]   = sector.i
+        channels[:,i,O_STATUS]    = status
+        channels[:,i,O_GEAR]      = np.where(shifting, np.nan, gear)
+        channels[:,i,O_LONG_ACC]  = a_long/stacked.g
+        channels[:,i,O_LAT_ACC]   = a_lat/stacked.g
+        channels[:,i,O_FR_REMAINING] = np.where(np.isfinite(F_tire_long_remaining), F_tire_long_remaining, 0)
+        channels[:,i,O_CURVATURE] = sector.curvature
+        channels[:,i,O_ENG_RPM]   = np.where(shifting, np.nan, eng_rpm)
+        channels[:,i,O_CO2]       = dl*F_tire_long*stacked.co2_factor/stacked.e_factor
+        channels[:,i,O_AERO_MODE] = aero_mode
+
+        if i<n-2:
+          stop = topped & (stopped == n)
+          if stop.any():
+            stopped[stop] = i
+            v_stopped[stop] = v[stop]
+            gear_stopped[stop] = gear[stop]
+            if (stopped < n).all():
+              break
+
+    for l in np.nonzero(stopped < n)[0]:
+      i = stopped[l]
+      channels[l,i,O_STATUS] = S_SUSTAINING
+      channels[l,i:,:] = np.tile(channels[l,i,:], (n-i,1))
+      channels[l,i+1:,O_TIME] += dl*np.arange(1,n-i)/v_stopped[l]
+      channels[l,i+1:,O_DISTANCE] += dl*np.arange(1,n-i)
+      v[l] = v_stopped[l]
+      gear[l] = gear_stopped[l]
+
+    # finish_drive() for each lane, with the lanes it would step braking back from vf for done together
+    braking = np.array([n > 1 and vmax[l]-vf[l] > 1e-1 and v[l]>vf[l] and self.braking_regime(vehicle, sector) is None
+      for l, vehicle in enumerate(vehicles)], dtype=bool)
+    if braking.any():
+      self.finish_braking_lanes(stacked, sector, channels, braking, x0, t0, vf, gear, dl)
+
+    results = []
+    for l, vehicle in enumerate(vehicles):
+      if braking[l]:
+        results.append(self.drive_result(channels[l], v0[l], vf[l], vmax[l]))
+      else:
+        results.append(self.finish_drive(vehicle, sector, channels[l], x0[l], t0[l], v0[l], v[l], vf[l], vmax[l], gear[l], dl))
+    return results
+
+  def finish_braking_lanes(self, stacked, sector, channels, braking, x0, t0, vf, gear, dl):
+    # finish_drive()'s braking, stepped back from vf until it meets the drive, for the lanes in braking at once
+    n = channels.shape[1]
+    active = braking.copy()
+    v = np.array(vf, dtype=np.float64)
+    t = np.zeros(len(active))
+    x = np.array(x0, dtype=np.float64)+dl*n
+    curvature = derate_curvature(sector.curvature, stacked.r_add)
+    weight = stacked.mass*stacked.g
+    modes = np.array([[AERO_FULL], [AERO_BRK]])
+
+    def splice(l, dt):
+      # put the lane's braking in time after the drive, dt being how far it is out
+      channels[l,-1,:] = channels[l,-2,:]
+      channels[l,-1,O_TIME]     = -1e-10
+      channels[l,-1,O_DISTANCE] = x0[l] + dl*n
+      channels[l,-1,O_VELOCITY] = vf[l]
+      braked = channels[l,:,O_TIME] < 0
+      channels[l,braked,O_TIME] += dt
+
+    with np.errstate(all='ignore'):
+      for i in reversed(range(n-1)):
+        v2 = corner_arrays.square(v)
+        a_lat = v2 * curvature
+        F_tire_lat = stacked.mass * a_lat
+
+        # airbrake whenever that drags more; the tires stay at what they give with full aero
+        N = weight + stacked.downforce(v2, modes)
+        drag = stacked.drag(v2, modes)
+        F_tire_long_available_FULL = stacked.f_long_remain(4, N[0], F_tire_lat)
+        F_longitudinal_FULL = - F_tire_long_available_FULL - drag[0]
+        F_longitudinal_BRK = - F_tire_long_available_FULL - drag[1]
+        airbrake = F_longitudinal_FULL > F_longitudinal_BRK
+        aero_mode = np.where(airbrake, AERO_BRK, AERO_FULL)
+        F_longitudinal = np.where(airbrake, F_longitudinal_BRK, F_longitudinal_FULL)
+        N = np.where(airbrake, N[1], N[0])
+
+        a_long = F_longitudinal / stacked.mass
+        u = v2 - 2*a_long*dl
+        v = np.where(u > 0, np.sqrt(u), 0.0)
+
+        met = active & (v > channels[:,i,O_VELOCITY])
+        for l in np.nonzero(met)[0]:
+          splice(l, channels[l,i,O_TIME] - t[l])
+        active &= ~met
+        if not active.any():
+          break
+
+        t = t - np.where(v == 0, 1000, dl/v)
+        x = x - dl
+
+        row = channels[:,i,:].copy()
+        row[:,O_TIME]     = t
+        row[:,O_DISTANCE] = x
+        row[:,O_VELOCITY] = v
+        row[:,O_NR]       = N
+        row[:,O_SECTORS]  = sector.i
+        row[:,O_STATUS]   = S_BRAKING
+        row[:,O_GEAR]     = gear
+        row[:,O_LONG_ACC] = a_long/stacked.g
+        row[:,O_LAT_ACC]  = a_lat/stacked.g
+        row[:,O_FR_REMAINING] = 0
+        row[:,O_CURVATURE]    = sector.curvature
+        row[:,O_ENG_RPM]      = np.nan
+        row[:,O_CO2]          = 0
+        row[:,O_AERO_MODE]    = aero_mode
+        channels[:,i,:] = np.where(active[:,np.newaxis], row, channels[:,i,:])
+
+    # the lanes whose braking ran all the way back
+    for l in np.nonzero(active)[0]:
+      splice(l, t0[l] - t[l])
+
+  def solve_lanes(self, vehicles, sectors, dl=0.2, closed_loop=False):
+    """
+    solve() for several vehicles at once, driving each sector for all of them in lockstep (see lanes).
+    Returns the channel stack solve() would give for each vehicle.
+    """
+    if not lanes.stackable(vehicles):
+      return [self.solve(vehicle, sectors, dl=dl, closed_loop=closed_loop) for vehicle in vehicles]
+    stacked = lanes.VehicleLanes(vehicles)
+    n_lanes = len(vehicles)
+
+    steady_velocities = []
+    for vehicle in vehicles:
+      velocities = [vehicle.vmax for i in sectors]
+      for i, conditions in enumerate(self.steady_corner_batch(vehicle, sectors)):
+        if conditions is not None:
+          velocities[i] = conditions[O_VELOCITY]
+      steady_velocities.append(velocities)
+
+    channel_stack = np.zeros((n_lanes, sum([int(sector.length/dl) for sector in sectors]), O_MATRIX_COLS))
+    filled = 0
+    starts = []
+
+    if closed_loop:
+      # solve() picks vf with i left on the last sector by its corner loop
+      v0 = [min(velocities[-1],velocities[0]*0.95) for velocities in steady_velocities]
+      vf = [velocities[-1] for velocities in steady_velocities]
+    else:
+      v0 = [0 for vehicle in vehicles]
+      vf = [vehicle.vmax if 1>=len(velocities) else velocities[1] for vehicle, velocities in zip(vehicles, steady_velocities)]
+
+    drives = self.drive_lanes(stacked, vehicles,
+      sectors[0],
+      [0 for vehicle in vehicles],
+      [0 for vehicle in vehicles],
+      v0,
+      vf,
+      [velocities[0] for velocities in steady_velocities],
+      [np.nan for vehicle in vehicles], dl)
+
+    starts.append(0)
+    for l, (channels_corner, failed_start) in enumerate(drives):
+      channel_stack[l,:channels_corner.shape[0],:] = channels_corner
+    filled = drives[0][0].shape[0]
+
+    i = 1
+    while i<len(sectors):
+      vf = [vehicle.vmax for vehicle in vehicles]
+      for l, velocities in enumerate(steady_velocities):
+        if i+1>=len(velocities):
+          if closed_loop:
+            vf[l] = channel_stack[l,0,O_VELOCITY]
+        else:
+          vf[l] = velocities[i+1]
+
+      drives = self.drive_lanes(stacked, vehicles,
+        sectors[i],
+        channel_stack[:,filled-1,O_DISTANCE],
+        channel_stack[:,filled-1,O_TIME],
+        channel_stack[:,filled-1,O_VELOCITY],
+        vf,
+        [velocities[i] for velocities in steady_velocities],
+        channel_stack[:,filled-1,O_GEAR], dl)
+
+      starts.append(filled)
+      n = drives[0][0].shape[0]
+      for l, (channels_corner, failed_start) in enumerate(drives):
+        channel_stack[l,filled:filled+n,:] = channels_corner
+      filled += n
+
+      self.brake_back_lanes(stacked, vehicles, sectors, steady_velocities, channel_stack, starts, filled, drives, i, dl)
+
+      i+=1
+
+    channel_stack[:,:,O_CO2] = np.cumsum(channel_stack[:,:,O_CO2], axis=1)
+
+    return [channel_stack[l] for l in range(n_lanes)]
+
   def steady_solve(self, vehicle, segments, dl=0.2):
-    return self.solve(vehicle, segments, dl=dl, closed_loop=True)
\ No newline at end of file
+    return self.solve(vehicle, segments, dl=dl, closed_loop=True)
+
+  def steady_solve_lanes(self, vehicles, segments, dl=0.2):
+    return self.solve_lanes(vehicles, segments, dl=dl, closed_loop=True)
\ No newline at end of file
@@ -0,0 +1,49 @@
+import sys,os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/input_processing')
+import time
+import math
+import numpy as np
+from svgpathtools import svg2paths
+from scipy.interpolate import UnivariateSpline
+import input_processing.track_segmentation as trackseg
+
+# Times the SVG sampler against the per-sample np.append loop it replaced:
+#   python svg_benchmark.py [file.svg] [dl]
+
+def points_in_each_seg_append(path, dx, opts={}):
+	a = np.array([])
+	s = np.array([])
+	k = np.array([])
+	l = np.array([0])
+	sectors = []
+	for seg in path:
+		ls = np.linspace(0,1,int(seg.length()/dx))[:-1]
+		x = seg.poly()(ls)
+		for i in ls:
+			k = np.append(k, seg.curvature(i))
+		a = np.append(a, x)
+		s = np.append(s, np.ones_like(x)*len(sectors))
+		sectors.append(a.shape[0])
+	for i in range(1,len(a)):
+		l = np.append(l, l[-1]+math.hypot(a.real[i]-a.real[i-1],-a.imag[i]+a.imag[i-1]))
+	spl = UnivariateSpline(l, k, k=opts['smoothing_dof'] if 'smoothing_dof' in opts else 2)
+	spl.set_smoothing_factor(opts['smoothing'] if 'smoothing' in opts else 0.005)
+
+	return (np.stack((a.real,-a.imag,spl(l),s.real),axis=1),sectors)
+
+if __name__ == "__main__":
+	fn = sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.abspath(__file__)) + '/params/tracks/ne_2015_endurance.svg'
+	dl = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+	path = svg2paths(fn)[0][0]
+
+	t0 = time.time()
+	old, old_sectors = points_in_each_seg_append(path, dl)
+	t1 = time.time()
+	new, new_sectors = trackseg.points_in_each_seg(path, dl, False)
+	t2 = time.time()
+
+	print("%s at dl=%g: %d samples" % (os.path.basename(fn), dl, new.shape[0]))
+	print("np.append loop: %.2f s" % (t1 - t0))
+	print("preallocated:   %.3f s (%.0fx)" % (t2 - t1, (t1 - t0) / (t2 - t1)))
+	print("max difference: %g, sectors %s" % (np.max(np.abs(old - new)), "match" if old_sectors == new_sectors else "DIFFER"))
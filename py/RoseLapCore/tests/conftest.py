@@ -0,0 +1,6 @@
+import sys,os
+
+# the package imports its modules by bare name, from its own directory and input_processing's
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(ROOT + '/input_processing')
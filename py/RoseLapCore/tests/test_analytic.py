@@ -0,0 +1,44 @@
+import os
+import pytest
+import numpy as np
+import sims
+from sims import constants
+import input_processing.vehicle as ipvehicle
+import input_processing.fancyyaml as yaml
+import input_processing.track_segmentation as trackseg
+
+"""
+ss_one_tire_analytic against the ss_one_tire stepper on the shipped DXF tracks and vehicles: every
+row's time has to agree to within TOLERANCE seconds.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOLERANCE = 1e-6
+DL = 0.2
+
+TRACKS = sorted([f for f in os.listdir(ROOT + '/params/tracks') if f.lower().endswith('.dxf')])
+VEHICLES = sorted([f for f in os.listdir(ROOT + '/params/vehicles') if f.endswith('.yaml')])
+
+def load_vehicle(vehicle_file):
+  vehicle = ipvehicle.Vehicle(yaml.load(open(ROOT + '/params/vehicles/' + vehicle_file), True))
+  vehicle.prep()
+  return vehicle
+
+@pytest.mark.parametrize('steady', [False, True])
+@pytest.mark.parametrize('vehicle_file', VEHICLES)
+@pytest.mark.parametrize('track', TRACKS)
+def test_analytic_matches_stepper(track, vehicle_file, steady):
+  sectors = trackseg.file_to_segments(ROOT + '/params/tracks/' + track, DL, sectors_only=True)
+  vehicle = load_vehicle(vehicle_file)
+
+  outputs = []
+  for model in ['ss_one_tire', 'ss_one_tire_analytic']:
+    sim = sims.Simulation(model)
+    outputs.append(sim.steady_solve(vehicle, sectors, dl=DL) if steady else sim.solve(vehicle, sectors, dl=DL))
+  stepped, analytic = outputs
+
+  assert stepped.shape == analytic.shape
+  times = (stepped[:,constants.O_TIME], analytic[:,constants.O_TIME])
+  # a lap that is NaN must be NaN in both
+  assert np.array_equal(np.isnan(times[0]), np.isnan(times[1]))
+  assert np.nanmax(np.abs(times[0] - times[1]), initial=0) <= TOLERANCE
@@ -0,0 +1,38 @@
+import os
+import pytest
+import numpy as np
+import sims
+from sims import constants
+import input_processing.vehicle as ipvehicle
+import input_processing.fancyyaml as yaml
+import input_processing.track_segmentation as trackseg
+
+"""
+one_tire_envelope against one_tire's bisection on the shipped DXF tracks and vehicles: the lap has
+to run all the way through, with a lap time within TOLERANCE (a fraction) of the bisected one.
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOLERANCE = 0.02
+DL = 1.0
+
+TRACKS = sorted([f for f in os.listdir(ROOT + '/params/tracks') if f.lower().endswith('.dxf')])
+VEHICLES = sorted([f for f in os.listdir(ROOT + '/params/vehicles') if f.endswith('.yaml')])
+
+def load_vehicle(vehicle_file):
+  vehicle = ipvehicle.Vehicle(yaml.load(open(ROOT + '/params/vehicles/' + vehicle_file), True))
+  vehicle.prep()
+  return vehicle
+
+@pytest.mark.parametrize('vehicle_file', VEHICLES)
+@pytest.mark.parametrize('track', TRACKS)
+def test_envelope_close_to_bisection(track, vehicle_file):
+  segments = trackseg.file_to_segments(ROOT + '/params/tracks/' + track, DL)
+  vehicle = load_vehicle(vehicle_file)
+
+  bisected, enveloped = [sims.Simulation(model).solve(vehicle, segments) for model in ['one_tire', 'one_tire_envelope']]
+
+  assert not np.isnan(enveloped[:,constants.O_TIME]).any()
+  assert np.all(np.diff(enveloped[:,constants.O_DISTANCE]) > 0)
+  lap_times = (bisected[-1,constants.O_TIME], enveloped[-1,constants.O_TIME])
+  assert abs(lap_times[1] - lap_times[0]) <= TOLERANCE*lap_times[0]
@@ -15,6 +15,7 @@ try:
     import input_processing
     import batcher
     import packer
+    import run_cache
     import pymysql as sql
     from RoseLapCharter import dashboarder
 except:
@@ -29,6 +30,8 @@ if __name__ == "__main__":
     try:
         runID = sys.argv[1]
         bcID = sys.argv[2]
+        # --resume picks up a result file an earlier, interrupted run of this config left behind
+        resume = "--resume" in sys.argv[3:]
 
         db = sql.connect("localhost", "rlapp", "gottagofast", "roselap")
         cur = db.cursor()
@@ -71,13 +74,15 @@ if __name__ == "__main__":
         tests, vehicle, tracks, model, out = input_processing.process_web_input(conf)
 
         logging.info('batching...')
-        results = batcher.batch(tests, vehicle, tracks, model, out[1] != 0)
+        batcher.track_segmentation.set_segment_cache_dir(run_cache.SEGMENT_DIR)
+        study = batcher.study_key(tests, vehicle, tracks, model, out[1])
+        writer = packer.study_writer(out[0], study, resume)
+        results = batcher.batch(tests, vehicle, tracks, model, out[1], cache=run_cache.RunCache(), writer=writer)
 
         db = sql.connect("localhost", "rlapp", "gottagofast", "roselap")
         cur = db.cursor()
 
-        logging.info('packing...')
-        result_path = packer.pack(results, out[0])
+        result_path = writer.filename
         
         display_dir = config.file_dir + "/graph/" + unique_id
         os.makedirs(display_dir)